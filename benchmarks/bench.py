@@ -0,0 +1,293 @@
+"""Microbenchmarks for the printer hot paths.
+
+Usage:
+    python benchmarks/bench.py                                  # run and print results
+    python benchmarks/bench.py --save baseline.json             # run and store the results as a baseline
+    python benchmarks/bench.py --compare baseline.json -t 15    # fail if anything is >15% slower than the baseline
+    python benchmarks/bench.py -k display                       # run only benchmarks containing "display"
+
+All the data (image packs, gcode, GRBL responses) is synthetic and generated in a temporary directory,
+so no printer hardware is required. Timings are medians of several repetitions in seconds per repetition."""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+from zipfile import ZipFile, ZIP_STORED
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d7print.display import BAKED_CACHE_SIZE, Display  # noqa: E402
+from d7print.grbl import Grbl  # noqa: E402
+from d7print.image_mapper import ImageMapper  # noqa: E402
+from d7print.preprocessor import Preprocessor  # noqa: E402
+from d7print.ruleset import Ruleset  # noqa: E402
+
+SCREEN_SHAPE = (2560, 1440)  # rows, columns - must match d7print/mask.png
+SCREEN_SLICES = BAKED_CACHE_SIZE + 1  # cycling through them defeats the display cache
+MANY_SLICES = 20000
+MANY_LAYERS = 10000
+
+# a typical print configuration: several overlapping layer- and height-based rules
+RULES = [
+    '1 hl 0.05 fd 60 fu 120 hr 5 tb 2 te 8 ts 0 ta 1',
+    '2 l 1-10 hl 0.05 te 60~10 tb 5',
+    '3 l 1-5 fd 20-60 adh 1-0 adn 10-1',
+    '4 z 0-2 fu 30~120 auh 2 aun 5',
+    '5 z 2-100 tb 3~1',
+    '6 l 11-200 te 10-8',
+    '7 z 100-200 ta 0.5',
+    '8 l 5000-6000 fd 40',
+    '9 z 300-400 te 9',
+    '10 l 9000-10000 tb 1-2',
+]
+
+_benchmarks: dict[str, tuple[Callable, int]] = {}
+
+
+def bench(name: str, reps: int):
+    """Register a benchmark. The decorated function prepares the data and returns a callable being timed."""
+    def decorator(setup: Callable[[str], Callable[[], object]]):
+        _benchmarks[name] = (setup, reps)
+        return setup
+    return decorator
+
+
+def _png(seed: int) -> bytes:
+    """Encode a screen-sized grayscale slice with a few random rectangles lit."""
+    rng = np.random.default_rng(seed)
+    img = np.zeros(SCREEN_SHAPE, dtype='uint8')
+    for _ in range(20):
+        y, x = rng.integers(0, SCREEN_SHAPE[0] - 300), rng.integers(0, SCREEN_SHAPE[1] - 300)
+        h, w = rng.integers(10, 300, size=2)
+        img[y:y + h, x:x + w] = 255
+    buf = io.BytesIO()
+    Image.fromarray(img, 'L').save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def _screen_pack(tmp: str) -> str:
+    path = os.path.join(tmp, 'screen.zip')
+    if not os.path.exists(path):
+        with ZipFile(path, 'w', ZIP_STORED) as zf:
+            for i in range(1, SCREEN_SLICES + 1):
+                zf.writestr(f'slice_{i}.png', _png(i))
+    return path
+
+
+def _duplicates_pack(tmp: str) -> str:
+    """An archive of identical slices (e.g. a constant-section part)."""
+    path = os.path.join(tmp, 'duplicates.zip')
+    if not os.path.exists(path):
+        data = _png(1)
+        with ZipFile(path, 'w', ZIP_STORED) as zf:
+            for i in range(1, 5):
+                zf.writestr(f'slice_{i}.png', data)
+    return path
+
+
+def _many_slices_pack(tmp: str) -> str:
+    """An archive with a lot of (tiny) slices. Only the names matter for the image mapper."""
+    path = os.path.join(tmp, 'many.zip')
+    if not os.path.exists(path):
+        with ZipFile(path, 'w', ZIP_STORED) as zf:
+            for i in range(MANY_SLICES, 0, -1):  # reverse order to make alphanumeric sorting do some work
+                zf.writestr(f'slice_{i}.png', b'')
+    return path
+
+
+def _configured_preprocessor(tmp: str) -> Preprocessor:
+    pre = Preprocessor()
+    pre.set_image_pack(_many_slices_pack(tmp))
+    pre.preprocess_line(f'@layer 0.05 n 1 s 0.05 t {MANY_SLICES}')
+    pre.preprocess_line('@support 0.05 n 1 s 0.05 t 20')
+    for rule in RULES:
+        pre.preprocess_line('@rule ' + rule)
+    return pre
+
+
+@bench('display_preload', reps=10)
+def _display_preload(tmp: str):
+    display = Display(tmp, os.path.join(tmp, 'fb'))
+    display.set_image_pack(os.path.basename(_screen_pack(tmp)))
+    names = itertools.cycle([f'slice_{i}.png' for i in range(1, SCREEN_SLICES + 1)])
+    return lambda: display.preload(next(names))  # cycle the images to defeat the cache
+
+
+@bench('display_show', reps=20)
+def _display_show(tmp: str):
+    display = Display(tmp, os.path.join(tmp, 'fb'))
+    display.set_image_pack(os.path.basename(_screen_pack(tmp)))
+    names = itertools.cycle(['slice_1.png', 'slice_2.png'])  # both stay cached, an identical one would not be written
+    display.show(next(names))
+    return lambda: display.show(next(names))  # the cached image lookup and the frame buffer write
+
+
+@bench('display_preload_duplicate', reps=20)
+def _display_preload_duplicate(tmp: str):
+    display = Display(tmp, os.path.join(tmp, 'fb'))
+    display.set_image_pack(os.path.basename(_duplicates_pack(tmp)))
+    names = itertools.cycle([f'slice_{i}.png' for i in range(1, 5)])
+    return lambda: display.preload(next(names))  # distinct names with identical content
+
+
+@bench('display_preload_plate', reps=5)
+def _display_preload_plate(tmp: str):
+    display = Display(tmp, os.path.join(tmp, 'fb'))
+    pack = os.path.basename(_screen_pack(tmp))
+    display.set_image_pack(pack)
+    names = itertools.cycle([f'slice_{i}.png|{pack}:slice_{i % SCREEN_SLICES + 1}.png@0,0'
+                             for i in range(1, SCREEN_SLICES + 1)])
+    return lambda: display.preload(next(names))  # two full-screen slices composed (random ones can not be shifted)
+
+
+@bench('display_preload_transform', reps=10)
+def _display_preload_transform(tmp: str):
+    display = Display(tmp, os.path.join(tmp, 'fb'))
+    display.set_image_pack(os.path.basename(_screen_pack(tmp)))
+    display.set_transform('m h')  # mirrors, right angle rotations and shifts reorient a view, no gather
+    names = itertools.cycle([f'slice_{i}.png' for i in range(1, SCREEN_SLICES + 1)])
+    return lambda: display.preload(next(names))
+
+
+@bench('display_preload_transform_scaled', reps=10)
+def _display_preload_transform_scaled(tmp: str):
+    display = Display(tmp, os.path.join(tmp, 'fb'))
+    display.set_image_pack(os.path.basename(_screen_pack(tmp)))
+    display.set_transform('s 0.95')  # scaling (or any other angle) needs the per-pixel gather
+    names = itertools.cycle([f'slice_{i}.png' for i in range(1, SCREEN_SLICES + 1)])
+    return lambda: display.preload(next(names))
+
+
+@bench('image_mapper_set_image_pack', reps=5)
+def _image_mapper_set_image_pack(tmp: str):
+    mapper = ImageMapper()
+    path = _many_slices_pack(tmp)
+    return lambda: mapper.set_image_pack(path)
+
+
+@bench('image_mapper_get_entry', reps=5)
+def _image_mapper_get_entry(tmp: str):
+    mapper = ImageMapper()
+    mapper.set_image_pack(_many_slices_pack(tmp))
+
+    def run():
+        mapper.add_layer(f'0.05 n 1 s 0.05 t {MANY_SLICES}')  # resets the cached map
+        for z in range(0, MANY_SLICES * 50, 50):
+            mapper.get_layer(z)
+        mapper.clear()
+    return run
+
+
+@bench('ruleset_get_layer_rule', reps=3)
+def _ruleset_get_layer_rule(_tmp: str):
+    def run():
+        ruleset = Ruleset()
+        for rule in RULES:
+            ruleset.add_rule(rule)
+        for layer in range(1, MANY_LAYERS + 1):
+            ruleset.get_layer_rule(layer)
+    return run
+
+
+@bench('preprocessor_print', reps=3)
+def _preprocessor_print(tmp: str):
+    pre = _configured_preprocessor(tmp)
+    return lambda: pre.preprocess_line('@print 1')
+
+
+@bench('grbl_parse', reps=5)
+def _grbl_parse(_tmp: str):
+    grbl = Grbl('/dev/null', 115200, 0.25)  # never opened
+    chunk = (b'ok\r\n' * 8 + b'<Run|MPos:0.000,0.000,12.345|Bf:15,128|FS:120,0|Pn:Z>\r\n'
+             + b'<Idle|MPos:0.000,0.000,12.345|Bf:15,128|FS:0,0|Ov:100,100,100>\r\n')
+    data = chunk * (1024 * 1024 // len(chunk))  # ~1MB of typical traffic
+
+    def run():
+        result = []
+        for i in range(0, len(data), 4096):  # Grbl.receive reads up to 4096 bytes at once
+            result.extend(grbl._parse_bytes(memoryview(data)[i:i + 4096]))
+        return result
+    return run
+
+
+@bench('api_info_full_queue', reps=5)
+def _api_info_full_queue(tmp: str):
+    from flask import Flask
+    app = Flask('bench')
+    queue = _configured_preprocessor(tmp).preprocess_line('@print 1')
+    log = [{'id': i, 'time': time.time(), 'msg': f'> G1 F60 Z{i / 100:.2f}'} for i in range(100)]
+    payload = {'status': 'ok', 'log': log, 'queue': queue, 'file': 'many.zip',
+               'state': 'Idle|MPos:0.000,0.000,12.345|Bf:15,128|FS:0,0', 'cfg': None, 'cfg_version': 1}
+
+    def run():
+        with app.app_context():
+            return app.json.response(payload).get_data()
+    return run
+
+
+def run_benchmarks(name_filter: str) -> dict[str, dict]:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='d7bench') as tmp:
+        for name, (setup, reps) in _benchmarks.items():
+            if name_filter and name_filter not in name:
+                continue
+            func = setup(tmp)
+            func()  # warm up caches and lazy initialization
+            times = []
+            for _ in range(reps):
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+            results[name] = {'median': statistics.median(times), 'min': min(times), 'reps': reps}
+            print(f'{name:32} median {results[name]["median"] * 1000:10.3f} ms   min {min(times) * 1000:10.3f} ms')
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> bool:
+    """Print relative changes of the medians. Returns False if any benchmark regressed beyond the threshold (%)."""
+    ok = True
+    for name, res in results.items():
+        if name not in baseline:
+            print(f'{name:32} (no baseline)')
+            continue
+        change = (res['median'] - baseline[name]['median']) / baseline[name]['median'] * 100
+        regressed = change > threshold
+        ok = ok and not regressed
+        print(f'{name:32} {change:+8.1f}%{"   REGRESSION" if regressed else ""}')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='d7print microbenchmarks')
+    parser.add_argument('-k', dest='filter', default='', help='run only benchmarks containing this substring')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a JSON baseline')
+    parser.add_argument('-t', '--threshold', type=float, default=10.0, help='allowed regression in percent')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.filter)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'results': results},
+                      f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""Deterministic replay of a serial I/O trace recorded on a printer (POST /api/trace cmd=start|stop).
+
+Usage:
+    python benchmarks/replay.py d7.20261019-120000.d7trace                 # replay and compare the timing
+    python benchmarks/replay.py d7.20261019-120000.d7trace --uploads DIR   # dir with the traced image pack
+
+The commands executed in the recorded session are fed through the real HwManager command loop again. GRBL is
+replaced with a pseudo terminal answering the way the recorded one did: every received line is sent back with the
+recorded delay after the replayed loop has written as many bytes as had been written before that line was received,
+status queries are answered with the latest recorded status report due by then and settings queries ("$$", also sent
+by the loop on its own) with the recorded settings report, or the settings cached when the recording started. Real-time commands sent by the
+API (hold, resume, stop) are repeated with the recorded delay after the same executed command.
+Prints per-command timing of the recording against the replay (the replay's own trace is kept for further analysis).
+Linux only (pseudo terminals), no printer hardware is required."""
+
+import argparse
+import json
+import logging
+import os
+import pty
+import select
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tty
+from bisect import bisect_left
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from d7print.hw_manager import HwManager  # noqa: E402
+from d7print.printers import DEFAULT_PRINTER  # noqa: E402
+from d7print.trace import read_trace, SEND, RECV, EXEC, META, REALTIME  # noqa: E402
+
+REPLAY_TIMEOUT_FACTOR = 3  # give up if the replay takes this many times longer than the recording
+
+
+class RecordedSession:
+    """Commands and GRBL behaviour extracted from a trace."""
+
+    def __init__(self, path: str):
+        self.meta: dict = {}
+        self.commands: list[tuple[float, str]] = []  # (time, command) of every executed queued command
+        self.responses: list[tuple[int, float, bytes]] = []  # (bytes sent before, delay since the send, line)
+        self.statuses: list[tuple[int, float, bytes]] = []  # the same for status reports
+        self.settings: list[bytes] = []  # "$n=value" lines of the last settings report (or of the cached settings)
+        self.realtime: list[tuple[int, float, str]] = []  # (executed commands before, delay since the last one, char)
+        self.led_on: list[float] = []  # M3 to M5 durations (seconds)
+
+        sent = 0  # bytes sent, except for the status and settings queries whose timing is not replayed
+        last_send = 0.0
+        line = b''
+        settings_query = False  # the settings report and its "ok" are being received
+        led_on_time = 0.0
+        for t, kind, payload in read_trace(path):
+            if kind == META:
+                self.meta = json.loads(payload)
+                self.settings = [f'${n}={v}\r\n'.encode() for n, v in (self.meta.get('settings') or {}).items()]
+            elif kind == EXEC:
+                self.commands.append((t, payload.decode('utf8', 'replace')))
+            elif kind == REALTIME:
+                last_exec = self.commands[-1][0] if self.commands else t
+                self.realtime.append((len(self.commands), t - last_exec, payload.decode('ascii')))
+            elif kind == SEND and payload.strip() == b'$$':
+                settings_query = True
+                self.settings = []
+            elif kind == SEND and payload != b'?':
+                sent += len(payload)
+                last_send = t
+                if payload.startswith(b'M3'):
+                    led_on_time = t
+                elif payload.startswith(b'M5') and led_on_time:
+                    self.led_on.append(t - led_on_time)
+                    led_on_time = 0.0
+            elif kind == RECV:
+                line += payload
+                while (end := line.find(b'\n')) >= 0:
+                    entry = (sent, max(t - last_send, 0.0), line[:end + 1])
+                    if line.startswith(b'<'):
+                        self.statuses.append(entry)
+                    elif not settings_query:
+                        self.responses.append(entry)
+                    elif line.startswith(b'$'):
+                        self.settings.append(entry[2])
+                    elif line.startswith((b'ok', b'error')):
+                        settings_query = False
+                    line = line[end + 1:]
+
+    def get_duration(self) -> float:
+        return self.commands[-1][0] - self.commands[0][0] if len(self.commands) > 1 else 0.0
+
+
+class FakeGrbl:
+    """Pseudo terminal GRBL answering as recorded (see the module description)."""
+
+    def __init__(self, session: RecordedSession):
+        self._session = session
+        self._master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._sent = 0
+        self._chunks: list[tuple[int, float]] = [(0, time.monotonic())]  # (bytes sent so far, time) after every read
+        self._next_response = 0
+        threading.Thread(target=self._run, name='fake_grbl', daemon=True).start()
+
+    def get_pending(self) -> int:
+        """Number of recorded responses not sent (yet)."""
+        return len(self._session.responses) - self._next_response
+
+    def _reached(self, sent: int) -> float | None:
+        """The time when the replayed loop had sent this many bytes, None if not yet."""
+        if sent > self._sent:
+            return None
+        index = bisect_left(self._chunks, (sent, 0.0))
+        return self._chunks[index][1]
+
+    def _run(self):
+        responses = self._session.responses
+        while True:
+            timeout = 0.05
+            while self._next_response < len(responses):
+                sent, delay, line = responses[self._next_response]
+                if (reached := self._reached(sent)) is None:
+                    break
+                if (wait := reached + delay - time.monotonic()) > 0:
+                    timeout = min(timeout, wait)
+                    break
+                os.write(self._master, line)
+                self._next_response += 1
+
+            if not select.select([self._master], [], [], timeout)[0]:
+                continue
+            data = os.read(self._master, 4096)
+            queries = data.count(b'?')
+            settings_queries = data.count(b'$$\n')
+            self._sent += len(data) - queries - settings_queries * 3
+            self._chunks.append((self._sent, time.monotonic()))
+            for _ in range(queries):
+                os.write(self._master, self._current_status())
+            for _ in range(settings_queries):
+                os.write(self._master, b''.join(self._session.settings) + b'ok\r\n')
+
+    def _current_status(self) -> bytes:
+        result = self._session.statuses[0][2] if self._session.statuses else b'<Idle|MPos:0.000,0.000,0.000>\r\n'
+        now = time.monotonic()
+        for sent, delay, line in self._session.statuses:
+            if (reached := self._reached(sent)) is None or reached + delay > now:
+                break
+            result = line
+        return result
+
+
+def replay(session: RecordedSession, uploads_dir: str, work_dir: str) -> tuple[HwManager, FakeGrbl, str]:
+    """Replay the session. Returns the manager, the fake GRBL and the replay trace path."""
+    grbl = FakeGrbl(session)
+    pack_dir = os.path.join(work_dir, 'pack')
+    os.makedirs(pack_dir)
+    pack = session.meta.get('pack', '')
+    if pack:
+        os.symlink(os.path.abspath(os.path.join(uploads_dir, pack)), os.path.join(pack_dir, pack))
+    printer = {**DEFAULT_PRINTER, 'name': 'replay', 'serial': grbl.port, 'fb': os.path.join(work_dir, 'fb'),
+               'gpio': -1, 'guard': os.path.join(work_dir, 'guard'), 'journal': os.path.join(work_dir, 'journal')}
+    hw_man = HwManager(logging.getLogger('replay'), pack_dir, printer)
+    if pack:
+        hw_man.set_image_pack(pack)
+    time.sleep(0.5)  # let the loop open the port
+    trace_name = hw_man.start_trace()
+
+    executed = []  # execution times of the queued commands
+    hw_man.add_log_listener(lambda entry: entry['msg'].startswith('> ') and executed.append(time.monotonic()))
+    hw_man.add_commands([cmd for _, cmd in session.commands])
+
+    realtime = list(session.realtime)
+    timeout = time.monotonic() + session.get_duration() * REPLAY_TIMEOUT_FACTOR + 10
+    while (hw_man.is_busy() or realtime) and time.monotonic() < timeout:
+        if realtime and len(executed) >= realtime[0][0]:
+            count, delay, char = realtime[0]
+            if not count or time.monotonic() >= executed[count - 1] + delay:
+                {'!': hw_man.hold, '~': hw_man.resume, '\x18': lambda: hw_man.clear_commands(True)}[char]()
+                realtime.pop(0)
+        time.sleep(0.001)
+    time.sleep(0.5)  # the last responses
+    hw_man.stop_trace()
+    return hw_man, grbl, os.path.join(pack_dir.rstrip('/') + '.traces', trace_name)
+
+
+def _stats(values: list[float]) -> str:
+    if not values:
+        return f'{"-":>30}'
+    p95 = sorted(values)[int(len(values) * 0.95) - 1] if len(values) >= 20 else max(values)
+    return f'{statistics.mean(values) * 1000:9.2f} {p95 * 1000:9.2f} {max(values) * 1000:9.2f}'
+
+
+def compare(recorded: RecordedSession, replayed: RecordedSession):
+    """Print the time between a command and the next one by command kind, and the LED on durations."""
+    print(f'Commands: recorded {len(recorded.commands)}, replayed {len(replayed.commands)}')
+    print(f'Duration: recorded {recorded.get_duration():.3f}s, replayed {replayed.get_duration():.3f}s')
+    if [c for _, c in recorded.commands] != [c for _, c in replayed.commands]:
+        print('WARNING: the replayed command sequence differs from the recorded one')
+
+    def gaps(session: RecordedSession) -> dict[str, list[float]]:
+        result: dict[str, list[float]] = {}
+        for (t, cmd), (next_t, _) in zip(session.commands, session.commands[1:]):
+            kind = cmd.partition(';')[0].split()[0].lower() if cmd.partition(';')[0].strip() else ';'
+            result.setdefault(kind, []).append(next_t - t)
+        return result
+
+    rec_gaps, rep_gaps = gaps(recorded), gaps(replayed)
+    print(f'{"command":<10} {"count":>6}   {"recorded mean/p95/max ms":>30}   {"replayed mean/p95/max ms":>30}')
+    for kind in sorted(rec_gaps, key=lambda k: -sum(rec_gaps[k])):
+        print(f'{kind:<10} {len(rec_gaps[kind]):>6}   {_stats(rec_gaps[kind])}   {_stats(rep_gaps.get(kind, []))}')
+    print(f'{"LED on":<10} {len(recorded.led_on):>6}   {_stats(recorded.led_on)}   {_stats(replayed.led_on)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='d7print serial trace replay')
+    parser.add_argument('trace', help='trace file recorded by the printer')
+    parser.add_argument('--uploads', default='/root/uploads/', help='dir with the image pack used by the trace')
+    args = parser.parse_args()
+
+    recorded = RecordedSession(args.trace)
+    if not recorded.commands:
+        parser.error('The trace does not contain any executed commands')
+    work_dir = tempfile.mkdtemp(prefix='d7replay-')
+    hw_man, grbl, replay_trace = replay(recorded, args.uploads, work_dir)
+    compare(recorded, RecordedSession(replay_trace))
+    if grbl.get_pending():
+        print(f'WARNING: {grbl.get_pending()} recorded responses were never due - the replay diverged')
+    print(f'Replay trace: {replay_trace}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,26 @@
 import os
+import time
 from logging.config import dictConfig
 from zipfile import ZipFile
 
-from flask import Flask, render_template, url_for, flash
+from flask import Flask, render_template, url_for, flash, send_file, abort, g
 from flask import request
+from werkzeug.local import LocalProxy
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename, redirect
 
+from d7print.catalog import PackCatalog
+from d7print.display import SliceCache
+from d7print.hw_client import HwClient
 from d7print.hw_manager import HwManager
+from d7print.preview import PreviewRenderer, FORMATS
+from d7print.printers import CONFIG_PATH, load_printers
+from d7print.profiler import SamplingProfiler
+from d7print.uploads import UploadManager
 
-# Main flask application
-def create_app():
-    # Logging config
+
+# Logging config shared by the web app and the hardware daemon
+def configure_logging(log_file: str):
     dictConfig({
         'version': 1,
         'formatters': {'default': {
@@ -20,7 +29,7 @@ def create_app():
         'handlers': {'file': {
             'class': 'logging.handlers.RotatingFileHandler',
             'formatter': 'default',
-            'filename': '/var/log/d7print.log',
+            'filename': log_file,
             'maxBytes': 1048576,
             'backupCount': 5
         }},
@@ -33,21 +42,61 @@ def create_app():
         }
     })
 
+
+# Main flask application
+def create_app():
+    configure_logging('/var/log/d7print.log')
+
     app = Flask(__name__)
     app.secret_key = 'd7_print_secret_key'
     uploads_dir = '/root/uploads/'
     os.makedirs(uploads_dir, 0o664, exist_ok=True)
 
-    hw_man = HwManager(app.logger, uploads_dir)
+    # Every configured printer gets its own HwManager: in the separate hardware daemon (see daemon.py)
+    # if its socket is configured, in-process otherwise. Packs and decoded slices are shared by all of them.
+    printer_cfgs = load_printers(os.environ.get('D7PRINT_CONFIG', CONFIG_PATH), uploads_dir)
+    printer_cfgs[0]['socket'] = printer_cfgs[0]['socket'] or os.environ.get('D7PRINT_HW_SOCKET', '')
+    slice_cache = SliceCache(4 * len(printer_cfgs))
+    printers: dict[str, HwManager | HwClient] = {}
+    for cfg in printer_cfgs:
+        printers[cfg['name']] = HwClient(cfg['socket']) if cfg['socket'] else \
+            HwManager(app.logger.getChild(cfg['name']), uploads_dir, cfg, slice_cache)
+    default_printer = printer_cfgs[0]['name']
+    hw_man: HwManager = LocalProxy(lambda: printers[g.printer])  # the printer selected by the request URL
+
+    def any_busy() -> bool:
+        return any(p.is_busy() for p in printers.values())
 
-    @app.route('/')
+    profiler = SamplingProfiler()
+    upload_man = UploadManager(uploads_dir, 1 << 30)
+    previews = PreviewRenderer(uploads_dir.rstrip('/') + '.previews/', 64 << 20)
+    catalog = PackCatalog(app.logger, uploads_dir, uploads_dir.rstrip('/') + '.catalog.sqlite', any_busy,
+                          lambda: [line for line in printers[default_printer].get_preprocessor_cfg()
+                                   if line.startswith(('@rule', '@sync'))], printer_cfgs[0]['pixel'])
+
+    def printer_route(rule: str, **options):
+        """Register a printer specific view at /p/<printer>/rule and at the plain rule for the first printer."""
+        def decorator(f):
+            app.add_url_rule(rule, view_func=f, **options)
+            app.add_url_rule('/p/<printer>' + rule, view_func=f, **options)
+            return f
+        return decorator
+
+    @app.url_value_preprocessor
+    def select_printer(endpoint, values):
+        g.printer = (values or {}).pop('printer', default_printer)
+        if g.printer not in printers:
+            abort(404)
+
+    @printer_route('/')
     def home():
         """Show the static homepage.
         Optional parameter "select" allows to choose the default value for the file load field"""
         active_file = hw_man.get_image_pack()
         select = request.args.get('select', '') or active_file
-        files = sorted(os.listdir(uploads_dir))
-        return render_template('home.htm', select=select, files=files, active_file=active_file)
+        files = catalog.get_packs()
+        return render_template('home.htm', select=select, files=files, active_file=active_file,
+                               printer=g.printer, printers=list(printers))
 
     @app.route('/upload', methods=['POST'])
     def upload():
@@ -57,7 +106,11 @@ def create_app():
         if not sec_name:
             flash('Invalid file name', 'warning')
             return redirect(url_for('home'))
-        f.save(uploads_dir + sec_name)
+        try:
+            upload_man.save(sec_name, f.stream)
+        except Exception as e:
+            flash(f'Upload failed: {e}', 'warning')
+            return redirect(url_for('home'))
         return redirect(url_for('home', select=sec_name))
 
     # API SECTION
@@ -65,10 +118,39 @@ def create_app():
     def _rp(name: str) -> str:
         return request.form.get(name, default='') or request.args.get(name, default='')
 
-    @app.route('/api/exec', methods=['GET', 'POST'])
+    def _lit_areas(file: str) -> list[int] | None:
+        """Cataloged lit areas of the pack images for the area rules (None until the pack is scanned)."""
+        areas = catalog.get_lit_areas(file)
+        return areas.tolist() if areas is not None else None
+
+    @app.route('/api/upload', methods=['GET', 'POST'])
+    def upload_chunk():
+        """Resumable chunked upload. The request body is the raw chunk data, parameters are passed in the query:
+        name - file name
+        offset - chunk position in the file (must be equal to the already received size)
+        total - full file size
+        id - client file id (e.g. its modification time), only the data of the same name, total and id is resumed
+        sha256 - optional expected SHA-256 of the whole file, checked when the last chunk is received
+        GET (or a mismatching offset) returns the already received size to resume from: {offset: int, done: bool}.
+        The file appears in the uploads dir only when it is complete and valid."""
+        name = secure_filename(request.args.get('name', default=''))
+        if not name:
+            return {'status': 'Bad file name'}
+        total = request.args.get('total', default=0, type=int)
+        file_id = request.args.get('id', default='0')
+        try:
+            if request.method == 'GET':
+                return {'status': 'ok', 'offset': upload_man.get_offset(name, total, file_id), 'done': False}
+            result = upload_man.write_chunk(name, request.args.get('offset', default=0, type=int), total, file_id,
+                                            request.stream, request.args.get('sha256', default=''))
+            return {'status': result.pop('error', 'ok'), **result, 'name': name}
+        except Exception as e:
+            return {'status': str(e)}
+
+    @printer_route('/api/exec', methods=['GET', 'POST'])
     def execute():
         """Send commands from "cmd" parameter for execution."""
-        if hw_man.get_commands():
+        if hw_man.is_busy():
             return {'status': 'Printer busy'}
         try:
             hw_man.add_commands(_rp('cmd').split('\n'))
@@ -76,7 +158,7 @@ def create_app():
         except Exception as e:
             return {'status': str(e)}
 
-    @app.route('/api/load', methods=['GET', 'POST'])
+    @printer_route('/api/load', methods=['GET', 'POST'])
     def load():
         """Load an archive file.
         If the file name is empty - clear current image pack.
@@ -86,7 +168,7 @@ def create_app():
         ... if it starts with "MAPFILE" - preprocess it and discard the output (keep the rules and layers)
         ... otherwise - return its contents to UI."""
 
-        if hw_man.get_commands():
+        if hw_man.is_busy():
             return {'status': 'Printer busy'}
 
         file: str = _rp('file')
@@ -105,7 +187,7 @@ def create_app():
                     lines = gcode.readlines()
             else:  # archive - use it as an image pack + load gcode if possible
                 with ZipFile(uploads_dir + file) as zf:
-                    hw_man.set_image_pack(file)
+                    hw_man.set_image_pack(file, _lit_areas(file))
                     if scripts := list(n for n in zf.namelist() if n.lower().endswith('.gcode')):
                         with zf.open(scripts[0]) as gcode:  # use the first available script
                             lines = [str(line, 'utf8') for line in gcode.readlines()]
@@ -118,83 +200,271 @@ def create_app():
         except Exception as e:
             return {'status': str(e)}
 
-    @app.route('/api/delete', methods=['GET', 'POST'])
+    @printer_route('/api/print', methods=['GET', 'POST'])
+    def print_file():
+        """Execute a gcode file or the first gcode script of an archive (which also becomes the current image pack).
+        The script is streamed into the execution queue directly from the file, it is not sent to the UI."""
+        if hw_man.is_busy():
+            return {'status': 'Printer busy'}
+
+        file = secure_filename(_rp('file'))
+        if not file:
+            return {'status': 'Bad filename'}
+
+        try:
+            if file.lower().endswith('.gcode'):
+                hw_man.stream_file(file)
+            else:
+                with ZipFile(uploads_dir + file) as zf:
+                    scripts = list(n for n in zf.namelist() if n.lower().endswith('.gcode'))
+                if not scripts:
+                    return {'status': 'No gcode script in the archive'}
+                hw_man.set_image_pack(file, _lit_areas(file))
+                hw_man.stream_file(file, scripts[0])
+            return {'status': 'ok'}
+        except Exception as e:
+            return {'status': str(e)}
+
+    @printer_route('/api/resume_print', methods=['POST'])
+    def resume_print():
+        """Resume the print interrupted by a service restart or a power loss from the layer after the last completed
+        one. Re-homes the printer and moves to a safe Z first. The generated program starts with a hold as usual."""
+        try:
+            info = hw_man.get_resume_info()
+            hw_man.resume_print(_lit_areas(info['pack']) if info else None)
+            return {'status': 'ok'}
+        except Exception as e:
+            return {'status': str(e)}
+
+    @printer_route('/api/delete', methods=['GET', 'POST'])
     def delete():
         """Delete selected file."""
         file: str = secure_filename(_rp('file'))
         if file:
             try:
-                if file == hw_man.get_image_pack():
-                    if hw_man.get_commands():
-                        return {'status': 'File is in use by printer'}
-                    else:
-                        hw_man.set_image_pack('')
+                for printer in printers.values():
+                    if file == printer.get_image_pack():
+                        if printer.is_busy():
+                            return {'status': 'File is in use by printer'}
+                        else:
+                            printer.set_image_pack('')
                 os.unlink(uploads_dir + file)
                 return {'status': 'ok'}
             except FileNotFoundError:
                 return {'status': 'Not found'}
         return {'status': 'Bad file name'}
 
-    @app.route('/api/info', methods=['GET'])
+    @printer_route('/api/info', methods=['GET'])
     def info():
         """Get current printer state:
+        printer - printer name: string
         log - a list of executed commands: [{id: int, time: int, msg: string}]
-        queue - a list of commands in the execution queue: [string]
+        queue - the first commands in the execution queue (up to "queue" parameter, 1000 by default): [string]
+        queue_length - number of commands in the execution queue: int
         file - currently loaded image pack: string
+        slices - number of slices in the image pack: int
         state - GRBL state line: string
+        grbl - structured GRBL status or null if expired: {state: string, mpos: [float], wpos: [float], ...}
         cfg - preprocessor config lines: [string]
         cfg_version - an increasing preprocessor config version number: string
+        resume - an interrupted print which can be resumed or null: {pack: string, layer: int, time: float}
 
         Accepts "time" and "cfg_version" parameters to reduce the output of log and cfg fields"""
 
         time = request.args.get('time', default=0, type=int)
+        queue_limit = max(request.args.get('queue', default=1000, type=int), 0)
         send_cfg = request.args.get('cfg_version', default=0, type=int) != hw_man.get_preprocessor_cfg_version()
         return {
             'status': 'ok',
+            'printer': g.printer,
             'log': [l for l in hw_man.get_log() if l['time'] >= time],
-            'queue': hw_man.get_commands(),
+            'queue': hw_man.get_commands(queue_limit),
+            'queue_length': hw_man.get_queue_length(),
             'file': hw_man.get_image_pack(),
+            'slices': hw_man.get_image_count(),
             'state': hw_man.get_grbl_state_line(),
+            'grbl': hw_man.get_grbl_status(),
             'cfg': hw_man.get_preprocessor_cfg() if send_cfg else None,
-            'cfg_version': hw_man.get_preprocessor_cfg_version()
+            'cfg_version': hw_man.get_preprocessor_cfg_version(),
+            'resume': hw_man.get_resume_info(),
         }
 
-    @app.route('/api/command', methods=['GET', 'POST'])
+    @printer_route('/api/exposures', methods=['GET'])
+    def exposures():
+        """Get measured exposures of the recently printed layers:
+        [{time: float, image: string, expose: int, actual: float, support: int, support_actual: float, late: float,
+          failed: bool}]
+        A failed exposure (M3 rejected by GRBL) has no measured times.
+        All durations are in milliseconds."""
+        return {'status': 'ok', 'exposures': hw_man.get_exposures()}
+
+    @printer_route('/api/preview', methods=['GET'])
+    def preview():
+        """Get a downscaled preview image of a slice from the active image pack as the printer would show it
+        (mapped by the configured @transform, without showing it on the screen):
+        slice - slice index (starting from 1)
+        width - preview width in pixels (default 360)
+        mask - 1 to apply the screen mask
+        format - png (default) or webp"""
+        file = hw_man.get_image_pack()
+        index = request.args.get('slice', default=0, type=int)
+        names = hw_man.get_image_names()
+        if not file or not 1 <= index <= len(names):
+            return {'status': 'No such slice'}, 404
+        width = min(max(request.args.get('width', default=360, type=int), 16), 1440)
+        mask = request.args.get('mask', default=0, type=int) == 1
+        fmt = request.args.get('format', default='png')
+        try:
+            entry = catalog.get_pack(file)
+            printer_cfg = next(cfg for cfg in printer_cfgs if cfg['name'] == g.printer)
+            transform = next((line[10:].strip() for line in hw_man.get_preprocessor_cfg()
+                              if line.startswith('@transform ')), '')
+            path = previews.get(uploads_dir + file, entry['sha256'] if entry else '', index, names[index - 1],
+                                width, mask, fmt, printer_cfg['mask'], transform, printer_cfg['pixel'])
+            return send_file(path, FORMATS[fmt], max_age=3600)
+        except Exception as e:
+            return {'status': str(e)}, 500
+
+    @printer_route('/api/command', methods=['GET', 'POST'])
     def command():
         """Accepts an immediate command for the printer:
         hold - immediately send "!" hold character to GRBL
         resume - send "~" resume to GRBL
         clear - clear the command queue
         stop - clear the command queue and issue "^X" soft-reset to GRBL
-        hardstop - hard-reset the GRBL MCU"""
+        hardstop - hard-reset the GRBL MCU
+        Real-time characters and the reset GPIO are written by the request thread itself, bypassing the command loop.
+        "latency" is the measured time from the printer call to the serial transmission (or GPIO write) in ms,
+        "call_latency" also includes the hardware daemon round trip (if used)."""
 
         cmd = _rp('cmd')
-        if cmd == 'hold':
-            hw_man.hold()
-        elif cmd == 'resume':
-            hw_man.resume()
-        elif cmd == 'clear':
-            hw_man.clear_commands()
-        elif cmd == 'stop':
-            hw_man.clear_commands(True)
-        elif cmd == 'hardstop':
-            hw_man.hard_stop()
-        else:
-            return {'status': 'Unknown command: ' + cmd}
-
-        return {'status': 'ok'}
+        start = time.perf_counter()
+        try:
+            if cmd == 'hold':
+                latency = hw_man.hold()
+            elif cmd == 'resume':
+                latency = hw_man.resume()
+            elif cmd == 'clear':
+                latency = hw_man.clear_commands()
+            elif cmd == 'stop':
+                latency = hw_man.clear_commands(True)
+            elif cmd == 'hardstop':
+                latency = hw_man.hard_stop()
+            else:
+                return {'status': 'Unknown command: ' + cmd}
+        except Exception as e:
+            return {'status': str(e)}
+
+        return {'status': 'ok', 'latency': latency, 'call_latency': round((time.perf_counter() - start) * 1000, 3)}
+
+    @printer_route('/api/latency', methods=['GET'])
+    def latency():
+        """Get measured latencies of the recent immediate commands: [{time: float, cmd: string, latency: float}]
+        (latency in ms, see /api/command)."""
+        return {'status': 'ok', 'latencies': hw_man.get_latencies()}
+
+    @printer_route('/api/settings', methods=['GET'])
+    def grbl_settings():
+        """Get the GRBL settings cached from the "$$" report: [{setting: int, value: string}], null if not read yet.
+        Served without any serial traffic. Setting writes ("$n=value" commands) which would not change the cached
+        value are skipped, so a whole settings profile can be applied again cheaply."""
+        return {'status': 'ok', 'settings': hw_man.get_grbl_settings()}
+
+    @printer_route('/api/benchmark', methods=['GET', 'POST'])
+    def benchmark():
+        """POST - measure the printer (the "benchmark" command, takes a few seconds, load a pack first to measure
+        the slice loading and the SD card). GET - the stored report with the derived settings (see probe.py)."""
+        if request.method == 'POST':
+            if hw_man.is_busy():
+                return {'status': 'Printer busy'}
+            hw_man.add_commands(['benchmark'])
+        return {'status': 'ok', 'benchmark': hw_man.get_benchmark()}
+
+    @app.route('/api/printers', methods=['GET'])
+    def printer_list():
+        """List the configured printers: [{name: string, busy: bool, file: string, state: string}].
+        Printer specific API is available at /p/<name>/api/..., the plain /api/... routes use the first printer.
+        A printer which can not be reached (hardware daemon is down) is reported with the error in "state"."""
+        result = []
+        for name, printer in printers.items():
+            try:
+                result.append({'name': name, 'busy': printer.is_busy(), 'file': printer.get_image_pack(),
+                               'state': printer.get_grbl_state_line()})
+            except Exception as e:
+                result.append({'name': name, 'busy': False, 'file': '', 'state': str(e)})
+        return {'status': 'ok', 'printers': result}
+
+    @printer_route('/api/trace', methods=['GET', 'POST'])
+    def trace():
+        """Serial I/O trace recording (see trace.py), e.g. to replay a production session with benchmarks/replay.py.
+        POST "cmd": start - start recording a new trace file, stop - stop recording.
+        GET - recording status and the recorded trace files of the printer:
+        {recording: {path: string, records: int, dropped: int} or null, files: [string]}
+        GET "file" - download the trace file."""
+        traces_dir = uploads_dir.rstrip('/') + '.traces/'
+        try:
+            if request.method == 'POST':
+                cmd = _rp('cmd')
+                if cmd == 'start':
+                    return {'status': 'ok', 'file': hw_man.start_trace()}
+                if cmd == 'stop':
+                    return {'status': 'ok', 'recording': hw_man.stop_trace()}
+                return {'status': 'Unknown command: ' + cmd}
+
+            if file := secure_filename(request.args.get('file', default='')):
+                return send_file(traces_dir + file, 'application/octet-stream', as_attachment=True)
+            files = sorted(n for n in os.listdir(traces_dir) if n.startswith(g.printer + '.')) \
+                if os.path.isdir(traces_dir) else []
+            return {'status': 'ok', 'recording': hw_man.get_trace_info(), 'files': files}
+        except Exception as e:
+            return {'status': str(e)}
+
+    @app.route('/api/profile', methods=['GET', 'POST'])
+    def profile():
+        """On-demand sampling profiler of the web app process (including the in-process printers)
+        and of every hardware daemon process. It does not run outside the profiling window.
+        POST "seconds" (default 30, at most 600) - start a new profiling window, discarding the previous results.
+        POST "stop=1" - stop profiling now.
+        GET - download the collected stacks in the collapsed format for flame graph tools. Every stack starts with
+        the process (web or hw-<printer>) and the thread name.
+        GET "info=1" - profiler status: {processes: [{name: string, running: bool, samples: int}]}"""
+        # (name, start, stop, get_result) of every process
+        processes = [('web', profiler.start, profiler.stop, profiler.get_result)]
+        processes.extend((f'hw-{name}', p.start_profiling, p.stop_profiling, p.get_profile)
+                         for name, p in printers.items() if isinstance(p, HwClient))
+        try:
+            if request.method == 'POST':
+                seconds = min(max(float(_rp('seconds') or 30), 1.0), 600.0)
+                for _, start, stop, _ in processes:
+                    if _rp('stop') == '1':
+                        stop()
+                    else:
+                        start(seconds)
+                return {'status': 'ok'}
+
+            results = [(name, get_result()) for name, _, _, get_result in processes]
+            if request.args.get('info') == '1':
+                return {'status': 'ok', 'processes': [
+                    {'name': name, 'running': r['running'], 'samples': r['samples']} for name, r in results]}
+            stacks = '\n'.join(f'{name};{stack}' for name, r in results for stack in r['stacks'])
+            return app.response_class(stacks + '\n', mimetype='text/plain', headers={
+                'Content-Disposition': 'attachment; filename=d7print-profile.txt'})
+        except Exception as e:
+            return {'status': str(e)}
 
     # UNUSED API SECTION
 
     @app.route('/api/ls', methods=['GET'])
     def ls():
-        return {'status': 'ok', 'files': sorted(os.listdir(uploads_dir))}
+        """List uploaded files. "packs" contains cataloged file metadata (see catalog.py)."""
+        packs = catalog.get_packs()
+        return {'status': 'ok', 'files': [p['name'] for p in packs], 'packs': packs}
 
-    @app.route('/api/log', methods=['GET'])
+    @printer_route('/api/log', methods=['GET'])
     def log():
         return {'status': 'ok', 'log': hw_man.get_log()}
 
-    @app.route('/api/grbl_state', methods=['GET'])
+    @printer_route('/api/grbl_state', methods=['GET'])
     def grbl_state():
         return {'status': 'ok', 'state': hw_man.get_grbl_state_line()}
 
@@ -0,0 +1,301 @@
+import ctypes
+import ctypes.util
+import hashlib
+import itertools
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+from queue import Queue
+from typing import Callable, Iterable
+from zipfile import ZipFile
+
+import numpy as np
+from PIL import Image
+
+from d7print.image_mapper import ImageMapper
+from d7print.plate import PIXEL_SIZE
+from d7print.preprocessor import Preprocessor
+from d7print.utils import lower_thread_priority
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packs (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    scanned INTEGER NOT NULL DEFAULT 0,  -- 1 when the metadata below is extracted
+    sha256 TEXT,
+    slices INTEGER,
+    width INTEGER,
+    height INTEGER,
+    mapfile INTEGER,
+    lit_mean REAL,  -- mean lit area of a slice (pixels)
+    lit_max INTEGER,  -- max lit area of a slice (pixels)
+    lit BLOB,  -- lit area of every slice in pack order (uint32 array, slice #1 first)
+    est_time REAL,  -- estimated print time of the pack's gcode script or MAPFILE layers (seconds)
+    error TEXT
+)'''
+_LIST_COLUMNS = ('name', 'size', 'scanned', 'sha256', 'slices', 'width', 'height', 'mapfile',
+                 'lit_mean', 'lit_max', 'est_time', 'error')
+
+
+class PackCatalog:
+    """Persistent SQLite catalog of the uploaded files.
+    Kept current by inotify (or by a rescan of the uploads dir if inotify is unavailable).
+    File metadata (hash, slice count, resolution, MAPFILE presence, lit area statistics and estimated print time)
+    is extracted by a background worker running at the lowest OS priority and paused while the printer is busy.
+    Print times of MAPFILE packs are estimated with the rules returned by get_rules (the printer config at the time
+    of the scan) and the screen pixel size (for the area rules)."""
+
+    def __init__(self, logger: logging.Logger, uploads_dir: str, db_path: str, busy: Callable[[], bool],
+                 get_rules: Callable[[], list[str]] = list, pixel_size: float = PIXEL_SIZE):
+        self._logger = logger
+        self._uploads_dir = uploads_dir
+        self._busy = busy
+        self._busy_failed = False
+        self._get_rules = get_rules
+        self._pixel_size = pixel_size
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute(_SCHEMA)
+        self._db_lock = threading.Lock()
+        self._scan_queue: Queue[str] = Queue()
+        self.rescan()
+        threading.Thread(target=self._watch_thread, name='catalog_watch', daemon=True).start()
+        threading.Thread(target=self._scan_thread, name='catalog_scan', daemon=True).start()
+
+    def get_packs(self) -> list[dict]:
+        """Get all cataloged files ordered by name (metadata fields are None until the file is scanned)."""
+        with self._db_lock:
+            rows = self._db.execute(f'SELECT {",".join(_LIST_COLUMNS)} FROM packs ORDER BY name').fetchall()
+        return [dict(zip(_LIST_COLUMNS, row)) for row in rows]
+
+    def get_pack(self, name: str) -> dict | None:
+        """Get a single file entry."""
+        with self._db_lock:
+            row = self._db.execute(f'SELECT {",".join(_LIST_COLUMNS)} FROM packs WHERE name = ?', (name,)).fetchone()
+        return dict(zip(_LIST_COLUMNS, row)) if row else None
+
+    def get_lit_areas(self, name: str) -> np.ndarray | None:
+        """Get the lit area (pixels) of every slice in the pack: index 0 is slice #1. None if not scanned yet."""
+        with self._db_lock:
+            row = self._db.execute('SELECT lit FROM packs WHERE name = ? AND scanned = 1', (name,)).fetchone()
+        return np.frombuffer(row[0], dtype='uint32') if row and row[0] is not None else None
+
+    def rescan(self):
+        """Synchronize the catalog with the uploads dir content."""
+        names = set(n for n in os.listdir(self._uploads_dir) if os.path.isfile(self._uploads_dir + n))
+        with self._db_lock:
+            known = set(row[0] for row in self._db.execute('SELECT name FROM packs'))
+        for name in known - names:
+            self._remove(name)
+        for name in names:
+            self._update(name)
+
+    # PRIVATE Section
+
+    def _update(self, name: str):
+        """Add or refresh the entry if the file is new or changed and queue it for metadata extraction."""
+        try:
+            st = os.stat(self._uploads_dir + name)
+        except FileNotFoundError:
+            self._remove(name)
+            return
+        with self._db_lock:
+            row = self._db.execute('SELECT size, mtime, scanned FROM packs WHERE name = ?', (name,)).fetchone()
+            if row and row[0] == st.st_size and row[1] == st.st_mtime and row[2]:
+                return
+            self._db.execute('INSERT OR REPLACE INTO packs (name, size, mtime) VALUES (?, ?, ?)',
+                             (name, st.st_size, st.st_mtime))
+            self._db.commit()
+        self._scan_queue.put(name)
+
+    def _remove(self, name: str):
+        with self._db_lock:
+            self._db.execute('DELETE FROM packs WHERE name = ?', (name,))
+            self._db.commit()
+
+    def _watch_thread(self):
+        try:
+            inotify = _Inotify(self._uploads_dir)
+        except OSError as e:
+            self._logger.warning(f'inotify is unavailable, falling back to periodic rescan: {e}')
+            while True:
+                time.sleep(10)
+                self.rescan()
+
+        while True:
+            for name, removed in inotify.read():
+                if removed:
+                    self._remove(name)
+                else:
+                    self._update(name)
+
+    def _scan_thread(self):
+        try:
+            lower_thread_priority()
+        except OSError as e:
+            self._logger.warning(f'Failed to lower catalog scanner priority: {e}')
+        while True:
+            name = self._scan_queue.get()
+            try:
+                meta = self._extract(name)
+            except FileNotFoundError as e:
+                if not os.path.exists(self._uploads_dir + name):  # removed while scanning - its entry is gone too
+                    continue
+                self._logger.warning(f'Failed to extract metadata of {name}: {e}')
+                meta = {'error': str(e)}
+            except Exception as e:
+                self._logger.warning(f'Failed to extract metadata of {name}: {e}')
+                meta = {'error': str(e)}
+            with self._db_lock:
+                columns = ', '.join(f'{k} = ?' for k in meta)
+                self._db.execute(f'UPDATE packs SET scanned = 1, {columns} WHERE name = ?', (*meta.values(), name))
+                self._db.commit()
+
+    def _wait_idle(self):
+        """Yield to the printer: wait while it is busy and give up the GIL for a moment."""
+        while self._is_busy():
+            time.sleep(1)
+        time.sleep(0.001)
+
+    def _is_busy(self) -> bool:
+        """A printer whose state can not be checked (e.g. its hardware daemon is not up yet) counts as busy."""
+        try:
+            busy = self._busy()
+        except Exception as e:
+            if not self._busy_failed:  # logged once per outage
+                self._logger.warning(f'Failed to check whether the printers are busy, scanning paused: {e}')
+            self._busy_failed = True
+            return True
+        self._busy_failed = False
+        return busy
+
+    def _extract(self, name: str) -> dict:
+        path = self._uploads_dir + name
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while block := f.read(1 << 20):
+                digest.update(block)
+                self._wait_idle()
+        meta = {'sha256': digest.hexdigest()}
+
+        if name.lower().endswith('.gcode'):
+            with open(path) as f:
+                meta['est_time'] = estimate_print_time(f, '')
+            return meta
+        if name.lower().endswith('.png'):
+            with Image.open(path) as img:
+                meta['width'], meta['height'] = img.size
+            return meta
+
+        mapper = ImageMapper()
+        mapper.set_image_pack(path)
+        image_names = mapper.get_image_names()
+        lit = np.zeros(len(image_names), dtype='uint32')
+        with ZipFile(path) as zf:
+            for i, image_name in enumerate(image_names):
+                with zf.open(image_name) as zi, Image.open(zi) as img:
+                    meta['width'], meta['height'] = img.size
+                    lit[i] = np.count_nonzero(np.asarray(img.getchannel(0)))
+                self._wait_idle()
+
+            meta['mapfile'] = 0
+            if scripts := [n for n in zf.namelist() if n.lower().endswith('.gcode')]:
+                with zf.open(scripts[0]) as gcode:
+                    lines = [str(line, 'utf8') for line in gcode.readlines()]
+                meta['mapfile'] = int(bool(lines) and lines[0].strip().lower().startswith('mapfile'))
+                meta['est_time'] = estimate_print_time(lines, path, lit.tolist(),
+                                                       self._load_rules() if meta['mapfile'] else [], self._pixel_size)
+
+        meta.update(slices=len(image_names), lit=lit.tobytes(),
+                    lit_mean=float(lit.mean()) if len(lit) else 0.0, lit_max=int(lit.max()) if len(lit) else 0)
+        return meta
+
+    def _load_rules(self) -> list[str]:
+        try:
+            return self._get_rules()
+        except Exception as e:  # e.g. the hardware daemon is restarting - the pack is cataloged without an estimate
+            self._logger.warning(f'Failed to get the rules for print time estimation: {e}')
+            return []
+
+
+def estimate_print_time(lines: Iterable[str], pack_path: str, lit_areas: list[int] | None = None,
+                        rules: list[str] | None = None, pixel_size: float = PIXEL_SIZE) -> float | None:
+    """Estimate the execution time (seconds) of a gcode script: delays, exposures, G4 pauses and Z moves.
+    Preprocessor directives are expanded. A MAPFILE script only configures the layers, the program printed from its
+    first layer ("@print 1") is estimated instead, using the rules (preprocessor directives, e.g. the configured
+    @rule lines) followed by the directives of the script. None if nothing is printed (or no rules apply)."""
+    preprocessor = Preprocessor(pixel_size)
+    if pack_path:
+        preprocessor.set_image_pack(pack_path, lit_areas)
+    total = 0.0
+    z = 0.0
+    feed = 0.0
+    printed = False
+    try:
+        lines = iter(lines)
+        if (first := next(lines, '')).strip().lower().startswith('mapfile'):
+            for line in [*(rules or []), *lines]:
+                preprocessor.preprocess_line(line)
+            lines = ['@print 1']
+        else:
+            lines = itertools.chain([first], lines)
+        for line in lines:
+            for raw_cmd in preprocessor.preprocess_line(line):
+                cmd = raw_cmd.partition(';')[0].strip().lower()
+                args = dict((m[0], float(m[1])) for m in re.findall(r'([a-z])\s*(-?[0-9.]+)', cmd))
+                if cmd.startswith('delay'):
+                    millis = re.findall(r'[0-9]+', cmd)
+                    total += int(millis[0]) / 1000 if millis else 0.0
+                elif cmd.startswith('expose'):
+                    total += sum(int(v) for v in cmd[6:].split()[:2]) / 1000
+                    printed = True
+                elif cmd.startswith('g4'):
+                    total += args.get('p', 0.0)
+                elif cmd.startswith(('g0', 'g1')):
+                    feed = args.get('f', feed)
+                    if 'z' in args:
+                        if feed > 0:
+                            total += abs(args['z'] - z) / feed * 60
+                        z = args['z']
+                elif cmd == 'm3':
+                    printed = True
+    except ValueError:
+        return None
+    return total if printed else None
+
+
+class _Inotify:
+    """Minimal ctypes inotify binding reporting file additions and removals in a single directory."""
+
+    _IN_CLOSE_WRITE = 0x008
+    _IN_MOVED_FROM = 0x040
+    _IN_MOVED_TO = 0x080
+    _IN_DELETE = 0x200
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        mask = self._IN_CLOSE_WRITE | self._IN_MOVED_FROM | self._IN_MOVED_TO | self._IN_DELETE
+        if libc.inotify_add_watch(self._fd, os.fsencode(directory), mask) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def read(self) -> list[tuple[str, bool]]:
+        """Block until some events are available. Returns a list of (file name, removed) tuples."""
+        data = os.read(self._fd, 65536)
+        result = []
+        pos = 0
+        while pos < len(data):
+            _, mask, _, length = self._EVENT.unpack_from(data, pos)
+            pos += self._EVENT.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if name:
+                result.append((name, bool(mask & (self._IN_MOVED_FROM | self._IN_DELETE))))
+        return result
@@ -0,0 +1,74 @@
+import argparse
+import json
+import logging
+import os
+import socketserver
+
+from d7print import configure_logging
+from d7print.display import SliceCache
+from d7print.hw_client import PROFILER_METHODS, RPC_METHODS
+from d7print.hw_manager import HwManager
+from d7print.printers import CONFIG_PATH, load_printers
+from d7print.profiler import SamplingProfiler
+
+
+class HwDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Runs HwManager in its own process and exposes it over a Unix socket, so the web app never shares the GIL with
+    the hardware timing loop.
+
+    Protocol: newline-delimited JSON.
+    RPC request: {"method": "get_log", "args": []} -> response: {"result": ...} or {"error": "message"}."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, hw_man: HwManager):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o660)
+        self.hw_man = hw_man
+        self.profiler = SamplingProfiler()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: HwDaemon
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                method = request.get('method')
+                if method in PROFILER_METHODS:  # the daemon process itself is profiled
+                    response = {'result': getattr(self.server.profiler, method)(*request.get('args', []))}
+                elif method in RPC_METHODS:
+                    response = {'result': getattr(self.server.hw_man, method)(*request.get('args', []))}
+                else:
+                    raise ValueError(f'Unknown method: {method}')
+            except Exception as e:
+                response = {'error': str(e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='d7print hardware daemon')
+    parser.add_argument('--socket', default='/run/d7print.sock', help='unix socket path')
+    parser.add_argument('--uploads', default='/root/uploads/', help='uploads dir')
+    parser.add_argument('--log', default='/var/log/d7print-hw.log', help='log file')
+    parser.add_argument('--config', default=CONFIG_PATH, help='printers config file')
+    parser.add_argument('--printer', default='', help='printer name (default: the first configured one)')
+    args = parser.parse_args()
+
+    configure_logging(args.log)
+    os.makedirs(args.uploads, 0o664, exist_ok=True)
+    printers = load_printers(args.config, args.uploads)
+    printer = next((p for p in printers if p['name'] == args.printer), None) if args.printer else printers[0]
+    if not printer:
+        parser.error(f'Unknown printer: {args.printer}')
+    slice_cache = SliceCache(4)  # the decoded slices preloaded by the printer and the reused ones
+    hw_man = HwManager(logging.getLogger(f'd7print.hw.{printer["name"]}'), args.uploads, printer, slice_cache)
+    with HwDaemon(args.socket, hw_man) as server:
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,198 @@
 import os
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable
 from zipfile import ZipFile
 
 import numpy as np
 from PIL import Image
 
+from d7print.plate import PIXEL_SIZE, is_composed, parse_name
+from d7print.resample import SliceTransform
+from d7print.trace import TraceRecorder, DISPLAY
+
+
+BAKED_CACHE_SIZE = 3  # masked frame buffer ready images kept by every display (~15MB each)
+
+
+class SliceCache:
+    """Small LRU cache of decoded (unmasked 8-bit) pack images shared by the displays of several printers.
+    Entries are keyed by the image content (see Display), so identical slices are decoded only once
+    no matter which pack or printer they come from."""
+
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._entries: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: tuple, loader: Callable[[], np.ndarray]) -> np.ndarray:
+        """Get the cached image or load it with loader() and cache the result."""
+        with self._lock:
+            if (img := self._entries.get(key)) is not None:
+                self._entries.move_to_end(key)
+                return img
+        img = loader()  # decode outside the lock - the other printers should not wait for it
+        img.flags.writeable = False  # shared between the displays
+        with self._lock:
+            self._entries[key] = img
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+        return img
+
 
 class Display:
-    """Loads images from file system and pack files, applies mask, writes to frame buffer."""
+    """Loads images from file system and pack files, applies mask, writes to frame buffer.
+    Pack images are identified by their content: CRC-32 and size from the archive central directory, indexed once
+    per pack. Identical slices share the decoded (optional shared SliceCache) and masked buffers,
+    and a buffer which is already on the screen is not written again.
+    Composed slice names (see plate.py) combine images of several packs shifted by their offsets into a single frame.
+    Slices of another resolution or orientation are mapped to the screen by the current SliceTransform
+    (pixel_size is the screen pixel pitch, mm)."""
 
-    def __init__(self, pack_dir: str, fb_device: str):
+    def __init__(self, pack_dir: str, fb_device: str, mask_path: str = '', cache: SliceCache | None = None,
+                 pixel_size: float = PIXEL_SIZE):
         self._fb_device = fb_device
         self._image_pack_dir = pack_dir
         self._image_pack_file: str = ''
-        self._img_mask = self._load_image('mask.png', os.path.dirname(os.path.abspath(__file__)), '')
+        self._cache = cache
+        self._pixel_size = pixel_size
+        mask_path = mask_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mask.png')
+        self._img_mask = self._load_image(os.path.basename(mask_path), os.path.dirname(mask_path), '')
+        # pack -> (its modification time when indexed, {image name -> (CRC-32, size)})
+        self._content_keys: dict[str, tuple[float, dict[str, tuple[int, int]]]] = {}
+        self._baked: OrderedDict[tuple, np.ndarray] = OrderedDict()  # content key -> masked image
+        self._transform = SliceTransform('', pixel_size)
         self._preload_buf = self._black()
         self._preload_name = ''
+        self._screen_buf: np.ndarray | None = None  # the buffer last written to the frame buffer
+        self._trace: TraceRecorder | None = None
+
+    def set_trace(self, trace: TraceRecorder | None):
+        """Record the frame buffer writes to the trace (None to stop)."""
+        self._trace = trace
 
     def set_image_pack(self, image_pack_path: str):
         """Set current image pack. Use empty string to clear."""
         self._image_pack_file = image_pack_path
+        self._content_keys = {}
 
     def get_image_pack(self) -> str:
         """Get currently loaded image pack."""
         return self._image_pack_file
 
+    def set_transform(self, spec: str):
+        """Set the transform of the loaded slices (see SliceTransform), empty string for none.
+        The cached masked images are dropped only if the transform actually changes."""
+        transform = SliceTransform(spec, self._pixel_size)
+        if transform.spec != self._transform.spec:
+            self._transform = transform
+            self._baked.clear()
+            self._preload_buf = self._black()
+            self._preload_name = ''
+
     def blank(self):
         """Fill frame buffer with all-black image."""
-        self._black().tofile(self._fb_device)
+        black = self._black()
+        black.tofile(self._fb_device)
+        self._screen_buf = black
+        if trace := self._trace:
+            trace.record(DISPLAY, 'blank')
 
     def preload(self, image_name: str):
         """Load the image from pack file (or from pack dir if not found in the pack), apply the mask,
         but do not write to frame buffer. The last loaded image is cached."""
         if image_name and image_name != self._preload_name:
-            img = self._load_image(image_name, self._image_pack_dir, self._image_pack_file)
-            if img.shape != self._img_mask.shape:
-                raise ValueError(f'Image shape {img.shape} does not match expected {self._img_mask.shape}')
-            # optimization: multiply 2 8-bit grayscale arrays, divide by 255 to return back to 8 bits, transform to ARGB
-            self._preload_buf = np.multiply(img, self._img_mask, dtype='uint32') // 255 * 0x00010101
+            self._preload_buf = self.load(image_name)
             self._preload_name = image_name
 
+    def get_preload_name(self) -> str:
+        """Get the name of the last preloaded image."""
+        return self._preload_name
+
+    def load(self, image_name: str) -> np.ndarray:
+        """Load the image (or compose the images of a composed name) and apply the mask. Returns a read-only
+        frame buffer ready array, does not touch the preload cache. Recently loaded pack images are served
+        by content from memory."""
+        if is_composed(image_name):
+            return self._load_composed(image_name)
+        key = self._get_content_key(image_name)
+        if key is not None and (buf := self._baked.get(key)) is not None:
+            self._baked.move_to_end(key)
+            return buf
+        img = self._load_image(image_name, self._image_pack_dir, self._image_pack_file, key)
+        return self._bake(self._transform.apply(img, self._img_mask.shape), key)
+
     def show(self, image_name: str):
         """Preload the image and write it to frame buffer."""
         self.preload(image_name)
-        self._preload_buf.tofile(self._fb_device)
+        self.write(self._preload_buf, self._preload_name)
+
+    def write(self, buf: np.ndarray, name: str = ''):
+        """Write an array returned by load() to frame buffer. Does nothing if it is already there
+        (consecutive identical slices). The name is used for tracing only."""
+        if buf is self._screen_buf:
+            return
+        self._screen_buf = None  # unknown screen content if the write fails
+        buf.tofile(self._fb_device)
+        self._screen_buf = buf
+        if trace := self._trace:
+            trace.record(DISPLAY, name)
+
+    def measure_load(self, image_name: str) -> tuple[float, float]:
+        """Load a pack image bypassing all the caches. Returns (decode time, transform and mask time) in seconds."""
+        start = time.perf_counter()
+        img = self._load_image(image_name, self._image_pack_dir, self._image_pack_file)
+        decoded = time.perf_counter()
+        self._bake(self._transform.apply(img, self._img_mask.shape), None)
+        return decoded - start, time.perf_counter() - decoded
+
+    def measure_write(self, count: int) -> list[float]:
+        """Write black frames to the frame buffer count times. Returns the write times (s), leaves the screen blank."""
+        frames = (self._black(), self._black())  # distinct buffers are never skipped
+        result = []
+        for i in range(count):
+            start = time.perf_counter()
+            self.write(frames[i % 2], 'blank')
+            result.append(time.perf_counter() - start)
+        return result
+
+    def _load_composed(self, image_name: str) -> np.ndarray:
+        """Combine the shifted images of several packs with a pixel-wise max into a single frame."""
+        parts = parse_name(image_name)
+        keys = [self._get_content_key(image, pack) for pack, image, _, _ in parts]
+        key = None if None in keys else tuple((k, dx, dy) for k, (_, _, dx, dy) in zip(keys, parts))
+        if key is not None and (buf := self._baked.get(key)) is not None:
+            self._baked.move_to_end(key)
+            return buf
+
+        frame = np.zeros(self._img_mask.shape, dtype='uint8')
+        height, width = frame.shape
+        for (pack, image, dx, dy), part_key in zip(parts, keys):
+            img = self._load_image(image, self._image_pack_dir, pack or self._image_pack_file, part_key)
+            img = self._transform.apply(img, frame.shape)
+            if img.shape != frame.shape:
+                raise ValueError(f'Image shape {img.shape} does not match expected {frame.shape}')
+            src = img[max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)]
+            if np.count_nonzero(src) != np.count_nonzero(img):
+                raise ValueError(f'{pack or self._image_pack_file}:{image} is shifted off the screen by {dx},{dy}')
+            dst = frame[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)]
+            np.maximum(dst, src, out=dst)
+        return self._bake(frame, key)
+
+    def _bake(self, img: np.ndarray, key: tuple | None) -> np.ndarray:
+        """Apply the mask and convert to the frame buffer format. The result is cached by the content key."""
+        if img.shape != self._img_mask.shape:
+            raise ValueError(f'Image shape {img.shape} does not match expected {self._img_mask.shape}'
+                             ' (use @transform for other resolutions)')
+        # optimization: multiply 2 8-bit grayscale arrays, divide by 255 to return back to 8 bits, transform to ARGB
+        buf = np.multiply(img, self._img_mask, dtype='uint32') // 255 * 0x00010101
+        buf.flags.writeable = False  # the same buffer is returned for every identical image
+        if key is not None:
+            self._baked[key] = buf
+            while len(self._baked) > BAKED_CACHE_SIZE:
+                self._baked.popitem(last=False)
+        return buf
 
     @staticmethod
     def _image_to_array_8(img: Image.Image) -> np.ndarray:
@@ -51,11 +201,32 @@ class Display:
     def _black(self):
         return np.zeros(self._img_mask.shape, dtype='uint32')
 
-    def _load_image(self, image_name: str, directory: str, pack_file: str) -> np.ndarray:
+    def _get_content_key(self, image_name: str, pack: str = '') -> tuple[int, int] | None:
+        """Content key of the image of the pack (the current one if empty), None if it is not in the pack.
+        Zip CRC-32 together with the exact size makes an accidental match of two different slices practically
+        impossible."""
+        pack = pack or self._image_pack_file
+        if not pack:
+            return None
+        pack_path = f'{self._image_pack_dir}/{pack}'
+        mtime = os.path.getmtime(pack_path)
+        indexed_mtime, keys = self._content_keys.get(pack, (0.0, {}))
+        if mtime != indexed_mtime:  # (re)index the pack: central directory only, no image data is read
+            with ZipFile(pack_path) as zf:
+                keys = dict((i.filename, (i.CRC, i.file_size)) for i in zf.infolist())
+            self._content_keys[pack] = (mtime, keys)
+        return keys.get(image_name)
+
+    def _load_image(self, image_name: str, directory: str, pack_file: str, key: tuple | None = None) -> np.ndarray:
         if pack_file:
             with ZipFile(f'{directory}/{pack_file}') as zf:
                 if image_name in zf.namelist():
-                    with zf.open(image_name) as zi, Image.open(zi) as i:
-                        return self._image_to_array_8(i)
+                    if self._cache and key is not None:
+                        return self._cache.get(key, lambda: self._read_member(zf, image_name))
+                    return self._read_member(zf, image_name)
         with Image.open(f'{directory}/{image_name}') as i:
             return self._image_to_array_8(i)
+
+    def _read_member(self, zf: ZipFile, image_name: str) -> np.ndarray:
+        with zf.open(image_name) as zi, Image.open(zi) as i:
+            return self._image_to_array_8(i)
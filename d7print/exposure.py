@@ -0,0 +1,129 @@
+import time
+from collections import deque
+
+import numpy as np
+
+from d7print.display import Display
+from d7print.grbl import Grbl
+
+SPIN_TIME = 0.002  # the last couple of ms before a deadline are waited with short sleeps instead of a single one
+
+
+class ExposureScheduler:
+    """Runs the layer exposure sequence (show the preloaded slice, LED on, optional support slice, LED off)
+    against time.monotonic() deadlines instead of separate command loop passes.
+    The owner is expected to sleep until get_deadline() and call poll() which fires all the due steps,
+    and to pass the GRBL responses to acknowledge() - an exposure whose M3 is rejected fails.
+    The actual (host-measured) exposure of every layer is recorded for QA."""
+
+    def __init__(self, display: Display, grbl: Grbl, history_size: int = 1000):
+        self._display = display
+        self._grbl = grbl
+        self._deadline: float = 0.0  # 0 - no exposure in progress
+        self._support_buf: np.ndarray | None = None
+        self._support_image = ''
+        self._support_ms = 0
+        self._support_preload: tuple[str, np.ndarray] | None = None  # (image name, loaded image) for the next start
+        self._led_on_pending = False  # M3 sent, its response not received yet
+        self._record: dict = {}
+        self._led_on_time = 0.0
+        self._support_time = 0.0
+        self._history = deque(maxlen=history_size)
+
+    def preload_support(self, support_image: str):
+        """Load the support image of the next exposure ahead of it (otherwise it is loaded while exposing)."""
+        if not self._support_preload or self._support_preload[0] != support_image:
+            self._support_preload = (support_image, self._display.load(support_image))
+
+    def start(self, expose_ms: int, support_image: str = '', support_ms: int = 0):
+        """Show the preloaded image and turn the LED on. Support image (if any) is taken from preload_support()."""
+        self._record = {
+            'time': time.time(),
+            'image': self._display.get_preload_name(),
+            'expose': expose_ms,
+            'actual': None,
+            'support': support_ms if support_image else 0,
+            'support_actual': None,
+            'failed': False,
+        }
+        self._display.show('')
+        self._grbl.send('M3\n')
+        self._led_on_pending = True
+        self._led_on_time = time.monotonic()
+        self._deadline = self._led_on_time + expose_ms / 1000
+
+        self._support_buf = None
+        if support_image and support_ms > 0:  # deadline is already set, so loading (if not preloaded) does not shift it
+            preload, self._support_preload = self._support_preload, None
+            self._support_buf = preload[1] if preload and preload[0] == support_image else \
+                self._display.load(support_image)
+            self._support_image = support_image
+            self._support_ms = support_ms
+
+    def acknowledge(self, line: str) -> dict | None:
+        """Pass a GRBL response ("ok" or "error..."). If it rejects M3 of the last exposure, the exposure is failed:
+        stopped (the screen is blanked) if still in progress, and recorded without timings. Returns its record then."""
+        if not self._led_on_pending:
+            return None
+        self._led_on_pending = False
+        if line.startswith('ok'):
+            return None
+        if self._deadline:
+            self.abort()
+            self._display.blank()
+            self._history.append(self._record)
+        self._record.update(actual=None, support_actual=None, late=None, failed=True)
+        return self._record
+
+    def is_active(self) -> bool:
+        """True if an exposure is in progress."""
+        return self._deadline > 0
+
+    def get_deadline(self) -> float:
+        """Monotonic time of the next step. 0 if no exposure is in progress."""
+        return self._deadline
+
+    def poll(self):
+        """Execute the next step if its deadline is reached. The last SPIN_TIME before it is waited right here."""
+        if not self._deadline:
+            return
+        remaining = self._deadline - time.monotonic()
+        if remaining > SPIN_TIME:
+            return
+        while (remaining := self._deadline - time.monotonic()) > 0:
+            time.sleep(remaining / 2)
+
+        now = time.monotonic()
+        if self._support_buf is not None:  # main exposure is over - switch to support image
+            self._display.write(self._support_buf, self._support_image)
+            self._support_buf = None
+            self._support_time = time.monotonic()
+            self._record['actual'] = round((self._support_time - self._led_on_time) * 1000, 2)
+            self._deadline = self._support_time + self._support_ms / 1000
+            return
+
+        self._grbl.send('M5\n')
+        led_off_time = time.monotonic()
+        if self._record['support']:
+            self._record['support_actual'] = round((led_off_time - self._support_time) * 1000, 2)
+        else:
+            self._record['actual'] = round((led_off_time - self._led_on_time) * 1000, 2)
+        self._record['late'] = round((now - self._deadline) * 1000, 3)  # wake-up error of the last step
+        self._history.append(self._record)
+        self._deadline = 0.0
+
+    def abort(self):
+        """Forget the exposure in progress (e.g. GRBL was reset and the LED is already off)."""
+        self._deadline = 0.0
+        self._support_buf = None
+        self._support_preload = None
+        self._led_on_pending = False
+
+    def get_last(self) -> dict | None:
+        """Get the record of the last finished exposure."""
+        return self._history[-1] if self._history else None
+
+    def get_history(self) -> list[dict]:
+        """Get the records of the recently finished exposures:
+        [{time, image, expose, actual, support, support_actual, late, failed}] (times in ms)."""
+        return list(self._history)
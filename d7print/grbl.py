@@ -1,19 +1,104 @@
+import re
 import time
 
 from serial import Serial, SerialException
 
+from d7print.trace import TraceRecorder, SEND, RECV
+
+_SETTING = re.compile(r'\$([0-9]+)=(\S*)')  # "$n=value" - both a setting write and a line of the "$$" report
+
+
+class GrblStatus:
+    """Structured GRBL 1.1 status report ("<Idle|MPos:0.000,0.000,1.000|Bf:15,128|FS:0,0|...>").
+    WCO and Ov fields are reported by GRBL only once in a while, so they are carried over from the previous report.
+    Both machine and work positions are available whichever of them was actually reported."""
+
+    def __init__(self, line: str = '', previous: 'GrblStatus' = None):
+        self.time: float = time.monotonic()  # report receive time
+        self.seq: int = previous.seq + 1 if previous else 0  # report sequence number
+        self.state: str = ''  # Idle, Run, Hold, Jog, Alarm, Door, Check, Home, Sleep
+        self.sub_state: int | None = None  # Hold:x and Door:x code
+        self.mpos: tuple[float, ...] | None = None  # machine position
+        self.wpos: tuple[float, ...] | None = None  # work position
+        self.wco: tuple[float, ...] | None = previous.wco if previous else None  # work coordinate offset
+        self.feed: float = 0.0  # current feed rate
+        self.speed: float = 0.0  # current spindle speed (LED PWM)
+        self.planner_free: int = -1  # available planner buffer blocks (-1 if not reported)
+        self.rx_free: int = -1  # available serial rx buffer bytes (-1 if not reported)
+        self.line_number: int | None = None
+        self.overrides: tuple[int, int, int] | None = previous.overrides if previous else None  # feed, rapid, spindle
+        self.pins: str = ''  # triggered input pins (X, Y, Z, P, D, H, R, S), reported only when any is active
+        self.accessories: str = ''  # S, C, F, M (spindle, coolant), reported only when any is active
+
+        parts = line.strip('<> \r\n').split('|')
+        state, _, sub_state = parts[0].partition(':')
+        self.state = state
+        self.sub_state = int(sub_state) if sub_state.isdigit() else None
+        for part in parts[1:]:
+            name, _, value = part.partition(':')
+            if name == 'MPos':
+                self.mpos = self._floats(value)
+            elif name == 'WPos':
+                self.wpos = self._floats(value)
+            elif name == 'WCO':
+                self.wco = self._floats(value)
+            elif name == 'Bf':
+                self.planner_free, self.rx_free = (int(v) for v in value.split(',')[:2])
+            elif name == 'Ln':
+                self.line_number = int(value)
+            elif name == 'FS':
+                self.feed, self.speed = self._floats(value)[:2]
+            elif name == 'F':
+                self.feed = float(value)
+            elif name == 'Ov':
+                self.overrides = tuple(int(v) for v in value.split(',')[:3])
+            elif name == 'Pn':
+                self.pins = value
+            elif name == 'A':
+                self.accessories = value
+
+        if self.wco:  # restore the missing position (WPos = MPos - WCO)
+            if self.mpos and not self.wpos:
+                self.wpos = tuple(round(m - o, 3) for m, o in zip(self.mpos, self.wco))
+            elif self.wpos and not self.mpos:
+                self.mpos = tuple(round(w + o, 3) for w, o in zip(self.wpos, self.wco))
+
+    def to_dict(self) -> dict:
+        """JSON-friendly representation."""
+        return {
+            'state': self.state,
+            'sub_state': self.sub_state,
+            'mpos': self.mpos,
+            'wpos': self.wpos,
+            'feed': self.feed,
+            'speed': self.speed,
+            'planner_free': self.planner_free,
+            'rx_free': self.rx_free,
+            'overrides': self.overrides,
+            'pins': self.pins,
+        }
+
+    @staticmethod
+    def _floats(value: str) -> tuple[float, ...]:
+        return tuple(float(v) for v in value.split(','))
+
 
 class Grbl:
     """Simple GRBL serial communication helper. Manages sending string commands, receiving responses line by line
-    and monitoring the status info in background."""
+    and monitoring the status info in background.
+    Status is polled every state_request_period while the machine is idle and every fast_state_request_period
+    while it is moving or when an up-to-date status was explicitly requested (or at a period set by the caller)."""
 
-    def __init__(self, port: str, baudrate: int, state_request_period: float):
+    def __init__(self, port: str, baudrate: int, state_request_period: float, fast_state_request_period: float = 0.0):
         self._serial = Serial()
         self._serial.port = port
         self._serial.baudrate = baudrate
         self._serial.timeout = 0
 
         self._state_request_period = state_request_period
+        self._fast_state_request_period = fast_state_request_period or state_request_period
+        self._fast_poll_seq = 0  # poll fast until a status report with this sequence number is received
+        self._poll_period = 0.0  # overrides both periods when set
         self._recv_buf = bytearray()
 
         self._state_response_expiry = 0.0
@@ -22,7 +107,27 @@ class Grbl:
         self._homing: bool = False
 
         self._status_line: list[str] = ['', '', '']
-        self._state: str = ''
+        self._status: GrblStatus = GrblStatus()
+        self._settings: dict[int, str] | None = None  # cached "$$" report, None until read (again after a reset)
+        self._settings_read: dict[int, str] | None = None  # the report being received
+        self._settings_quiet = False  # the report lines are not returned by receive() (requested by read_settings)
+        self._settings_requested = False  # read_settings() was called since the last reset
+        self._pending_setting: tuple[int, str] | None = None  # a sent setting write, cached when acknowledged
+        self._trace: TraceRecorder | None = None
+
+    def set_state_request_periods(self, state_request_period: float, fast_state_request_period: float):
+        """Change the status polling periods (see the class description)."""
+        self._state_request_period = state_request_period
+        self._fast_state_request_period = fast_state_request_period
+
+    def set_poll_period(self, period: float):
+        """Poll the status every period regardless of the state, e.g. while waiting for a motion to complete
+        (0 to go back to the regular periods)."""
+        self._poll_period = period
+
+    def set_trace(self, trace: TraceRecorder | None):
+        """Record all the sent and received bytes to the trace (None to stop)."""
+        self._trace = trace
 
     def send(self, cmd: str):
         """Send a text command (a single-character, a "\n"-terminated line, or multiple lines)"""
@@ -30,6 +135,15 @@ class Grbl:
             if not self._serial.is_open:
                 self._serial.open()
             self._serial.write(bytes(cmd, 'ascii'))
+            if trace := self._trace:
+                trace.record(SEND, cmd)
+            line = cmd.strip()
+            if line == '$$':
+                self._settings_read = {}
+            elif setting := _SETTING.fullmatch(line):
+                self._pending_setting = (int(setting[1]), setting[2])
+            elif line.upper().startswith('$RST='):  # $RST=$, * and # restore defaults without a welcome message
+                self._invalidate_settings()
         except SerialException:
             # noinspection PyBroadException
             try:
@@ -37,19 +151,63 @@ class Grbl:
             except Exception:
                 pass
 
+    def send_realtime(self, char: str) -> float:
+        """Write a single real-time command character ("!", "~", "\x18") right away and wait until it is transmitted.
+        May be called from any thread: GRBL picks real-time characters out of the serial stream even in the middle
+        of a line being sent by the execution thread, so no locking is needed. The wait is bounded by the output
+        queued before it (at most a single command line). Returns the elapsed time (seconds)."""
+        start = time.perf_counter()
+        if not self._serial.is_open:  # (re)opening is left to the execution thread
+            raise SerialException('GRBL serial port is not open')
+        self._serial.write(bytes(char, 'ascii'))
+        self._serial.flush()  # tcdrain - the character has left the UART
+        if trace := self._trace:
+            trace.record(SEND, char)
+        return time.perf_counter() - start
+
+    def read_settings(self):
+        """Send "$$" to (re)fill the settings cache. The report lines are cached, but not returned by receive(),
+        the final "ok" is. Meant to be called by the execution thread while it is not waiting for another response."""
+        self.send('$$\n')
+        self._settings_quiet = True
+        self._settings_requested = True
+
+    def get_settings(self) -> dict[int, str] | None:
+        """Get the cached GRBL settings {number: value}. None until "$$" is answered after a (re)connection or reset.
+        The cache follows the "$n=value" writes acknowledged by GRBL."""
+        return dict(self._settings) if self._settings is not None else None
+
+    def needs_settings(self) -> bool:
+        """True if the settings are unknown and read_settings() has not been tried since the last reset."""
+        return self._settings is None and not self._settings_requested
+
+    def is_setting_current(self, cmd: str) -> bool:
+        """True if cmd is a "$n=value" setting write which would not change the cached value (numbers are compared
+        by value, so "$11=0.01" matches the reported "$11=0.010")."""
+        setting = _SETTING.fullmatch(cmd.strip())
+        if not setting or self._settings is None or int(setting[1]) not in self._settings:
+            return False
+        current = self._settings[int(setting[1])]
+        try:
+            return float(setting[2]) == float(current)
+        except ValueError:
+            return setting[2] == current
+
     def receive(self) -> list[str]:
         """Receive GRBL's response line by line. Also send "?" status query when necessary and intercept the response."""
         try:
             if not self._serial.is_open:
                 self._serial.open()
-            if time.time() > self._last_state_request_time + self._state_request_period:
+            if time.time() > self._last_state_request_time + self._get_state_request_period():
                 self._last_state_request_time = time.time()
                 self._serial.write(b'?')
+                if trace := self._trace:
+                    trace.record(SEND, b'?')
 
-            result = []
-            for b in self._serial.read(4096):
-                self._parse_byte(b, result)
-            return result
+            data = self._serial.read(4096)
+            if data and (trace := self._trace):
+                trace.record(RECV, data)
+            return self._parse_bytes(data)
         except OSError as e:
             # noinspection PyBroadException
             try:
@@ -66,27 +224,89 @@ class Grbl:
 
     def get_state(self):
         """Idle, Run, Hold:x, Jog, Alarm, Door:x, Check, Home, Sleep"""
-        return self._state if self._state_response_expiry > time.time() else ''
+        status = self.get_status()
+        if not status:
+            return ''
+        return status.state if status.sub_state is None else f'{status.state}:{status.sub_state}'
+
+    def get_status(self) -> GrblStatus | None:
+        """Get the latest structured status report. None if it is unavailable for a while."""
+        return self._status if self._state_response_expiry > time.time() else None
+
+    def request_status(self) -> int:
+        """Send "?" status query right away and keep polling fast until it is answered.
+        Returns the sequence number of the first status report guaranteed to be requested after this call
+        (a reply to the previous query might still be in flight)."""
+        self.send('?')
+        self._last_state_request_time = time.time()
+        self._fast_poll_seq = self._status.seq + 2
+        return self._fast_poll_seq
 
     def close(self):
         self._serial.close()
 
-    def _parse_byte(self, b, parsed_lines: list[str]):
-        if b == 13 or b == 0:
-            return
+    def _get_state_request_period(self) -> float:
+        if self._poll_period:
+            return self._poll_period
+        if self._status.seq < self._fast_poll_seq or self._status.state in ('Run', 'Jog', 'Home'):
+            return self._fast_state_request_period
+        return self._state_request_period
 
-        if b != 10:
-            self._recv_buf.append(b)
-            return
+    def _parse_bytes(self, data: bytes | memoryview) -> list[str]:
+        """Split the received data into lines. An incomplete last line is kept in the buffer until the next call.
+        Status reports are intercepted and not included in the result."""
+        self._recv_buf += data
+        end = self._recv_buf.rfind(b'\n')
+        if end < 0:
+            return []
+
+        chunk = self._recv_buf[:end].translate(None, b'\r\x00')
+        del self._recv_buf[:end + 1]
+
+        result = []
+        for raw_line in chunk.split(b'\n'):
+            line = str(raw_line, 'ascii', 'replace')
+            if line.startswith('<'):  # intercept GRBL's status response
+                self._parse_status(line)
+                continue
+            if not self._parse_settings(line):
+                result.append(line)
+        return result
+
+    def _parse_settings(self, line: str) -> bool:
+        """Maintain the settings cache. Returns True if the line should not be returned by receive()."""
+        if line.startswith('Grbl ') or line.startswith('[MSG:Restoring defaults'):
+            self._invalidate_settings()  # welcome message after a reset - GRBL might have been reflashed
+        elif self._settings_read is not None and (setting := _SETTING.fullmatch(line)):
+            self._settings_read[int(setting[1])] = setting[2]
+            return self._settings_quiet
+        elif line.startswith(('ok', 'error')):
+            if self._settings_read is not None:
+                if line.startswith('ok'):
+                    self._settings = self._settings_read
+                self._settings_read = None
+                self._settings_quiet = False
+            elif self._pending_setting:
+                if line.startswith('ok') and self._settings is not None:
+                    self._settings[self._pending_setting[0]] = self._pending_setting[1]
+                self._pending_setting = None
+        return False
 
-        line = str(self._recv_buf, 'ascii')
-        self._recv_buf.clear()
-        if line.startswith('<'):  # intercept GRBL's status response
-            line_parts = line.strip('<> ').split('|')
-            self._state = line_parts[0]
-            self._status_line[0] = '|'.join(line_parts[0:4])
-            if len(line_parts) > 4:  # extra info received - put it to _status_line[1 or 2]
-                self._status_line[1 if line_parts[4].startswith('Ov') else 2] = line_parts[4]
-            self._state_response_expiry = time.time() + self._state_request_period * 2
-        else:
-            parsed_lines.append(line)
+    def _invalidate_settings(self):
+        """Forget the cached settings, they are read again (see needs_settings)."""
+        self._settings = None
+        self._settings_read = None
+        self._settings_requested = False
+        self._settings_quiet = False
+        self._pending_setting = None
+
+    def _parse_status(self, line: str):
+        line_parts = line.strip('<> ').split('|')
+        self._status_line[0] = '|'.join(line_parts[0:4])
+        if len(line_parts) > 4:  # extra info received - put it to _status_line[1 or 2]
+            self._status_line[1 if line_parts[4].startswith('Ov') else 2] = line_parts[4]
+        try:
+            self._status = GrblStatus(line, self._status)
+        except ValueError:  # malformed report (e.g. garbage after reset) - keep the previous one
+            return
+        self._state_response_expiry = time.time() + self._state_request_period * 2
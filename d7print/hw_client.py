@@ -0,0 +1,100 @@
+import json
+import select
+import socket
+import threading
+
+# HwManager methods available over the hardware daemon socket
+RPC_METHODS = (
+    'set_image_pack', 'get_image_pack', 'get_image_names', 'get_preprocessor_cfg', 'get_preprocessor_cfg_version',
+    'add_commands', 'preprocess', 'stream_file', 'get_commands', 'is_busy', 'clear_commands', 'hard_stop',
+    'hold', 'resume', 'get_log', 'get_grbl_state_line', 'get_grbl_status', 'get_exposures', 'get_resume_info',
+    'resume_print', 'get_name', 'get_latencies', 'start_trace', 'stop_trace', 'get_trace_info',
+    'get_grbl_settings', 'get_benchmark', 'get_image_count', 'get_queue_length',
+)
+# SamplingProfiler methods of the hardware daemon process
+PROFILER_METHODS = ('start', 'stop', 'get_result')
+# methods which may take long on big jobs (parsing and queueing a whole file)
+LONG_METHODS = ('add_commands', 'preprocess', 'stream_file')
+
+
+class HwClient:
+    """HwManager proxy talking to the hardware daemon (see daemon.py) over a Unix socket.
+    Exposes the same public methods. Every thread uses its own connection, reconnecting after failures.
+    A request is sent again only if the connection turns out to be stale before it is written (never after a timeout
+    or a lost response - the daemon might have executed it already). LONG_METHODS use long_timeout.
+    Errors raised by the daemon are re-raised as ValueError with the original message."""
+
+    def __init__(self, socket_path: str, timeout: float = 10.0, long_timeout: float = 300.0):
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._long_timeout = long_timeout
+        self._local = threading.local()
+
+    def __getattr__(self, name: str):
+        if name not in RPC_METHODS:
+            raise AttributeError(name)
+        return lambda *args: self._call(name, args)
+
+    def start_profiling(self, duration: float):
+        """Start the sampling profiler of the daemon process (see SamplingProfiler.start)."""
+        self._call('start', (duration,))
+
+    def stop_profiling(self):
+        self._call('stop', ())
+
+    def get_profile(self) -> dict:
+        """Get the daemon profiler results (see SamplingProfiler.get_result)."""
+        return self._call('get_result', ())
+
+    def _connect(self, timeout: float | None) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(self._socket_path)
+        return sock
+
+    def _call(self, method: str, args: tuple):
+        request = json.dumps({'method': method, 'args': args}).encode() + b'\n'
+        for attempt in (1, 2):  # the cached connection might have been closed by a daemon restart
+            sock = getattr(self._local, 'sock', None)
+            try:
+                if sock and self._is_stale(sock):
+                    raise ConnectionError('Stale hardware daemon connection')
+                if not sock:
+                    sock = self._local.sock = self._connect(self._timeout)
+                    self._local.file = sock.makefile('rwb')
+                sock.settimeout(self._long_timeout if method in LONG_METHODS else self._timeout)
+                self._local.file.write(request)
+                self._local.file.flush()
+                break
+            except TimeoutError:
+                self._close()
+                raise
+            except OSError:  # not written: a fresh connection is safe to retry on
+                self._close()
+                if attempt == 2:
+                    raise
+        try:
+            line = self._local.file.readline()
+            if not line:
+                raise ConnectionError('Hardware daemon closed the connection')
+        except OSError:  # the request might have been executed - never sent again
+            self._close()
+            raise
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response['result']
+
+    @staticmethod
+    def _is_stale(sock: socket.socket) -> bool:
+        """True if the daemon has closed the idle connection (there is never any unread data between calls)."""
+        return bool(select.select([sock], [], [], 0)[0]) and sock.recv(1, socket.MSG_PEEK) == b''
+
+    def _close(self):
+        for name in ('file', 'sock'):
+            if obj := getattr(self._local, name, None):
+                try:
+                    obj.close()
+                except OSError:
+                    pass
+            setattr(self._local, name, None)
@@ -1,15 +1,29 @@
+import json
 import logging
 import os
 import re
+import statistics
 import time
 from collections import deque
+from itertools import islice
 from threading import Lock, Thread
 from time import sleep
-from typing import List, Optional
+from typing import Callable, Iterator, List, Optional
 
-from d7print.display import Display
+from serial import SerialException
+
+from d7print.display import Display, SliceCache
+from d7print.exposure import ExposureScheduler
 from d7print.grbl import Grbl
+from d7print.journal import PrintJournal
 from d7print.preprocessor import Preprocessor
+from d7print.printers import DEFAULT_PRINTER
+from d7print.probe import measure_read, tune
+from d7print.trace import TraceRecorder, EXEC, IMMEDIATE, DELAY, META, REALTIME
+from d7print.utils import read_lines
+
+_LAYER_MARKER = re.compile(r';#+ Layer ([0-9]+)')  # layer header comment generated by the preprocessor
+SUPPORT_LOOKAHEAD = 8  # queued commands searched for the expose command following a preload
 
 
 class HwManager:
@@ -19,30 +33,63 @@ class HwManager:
     Maintains command queue and log.
     Runs a dedicated command execution thread."""
 
-    def __init__(self, logger: logging.Logger, pack_dir: str):
+    def __init__(self, logger: logging.Logger, pack_dir: str, printer: dict | None = None,
+                 slice_cache: SliceCache | None = None):
+        """printer - hardware config (see printers.py), DEFAULT_PRINTER if None.
+        slice_cache - decoded image cache shared with the other printers of this host."""
+        printer = printer or DEFAULT_PRINTER
         self._logger = logger
         self._pack_dir = pack_dir
+        self._name = printer['name']
 
         # Hard-coded configuration and subsystem initialization:
         self._comm_period = 0.05
-        self._guard_file = '/var/run/d7print.guard'
-        self._gpio_reset_path = '/sys/class/gpio/gpio7/value'
-        open('/sys/class/gpio/export', 'w').write('7')
-        open('/sys/class/gpio/gpio7/direction', 'w').write('high')
-        self._display = Display(pack_dir, '/dev/fb0')
-        self._grbl = Grbl('/dev/ttyS3', 115200, self._comm_period * 5)
-        self._preprocessor = Preprocessor()
+        self._sync_period = 0.01  # status polling and loop period while waiting for "sync" (not tuned, GRBL-bound)
+        self._stream_queue_size = 200  # streamed commands are read ahead until the queue holds this many
+        self._guard_file = printer['guard']
+        gpio = printer['gpio']
+        self._gpio_reset_path = f'/sys/class/gpio/gpio{gpio}/value' if gpio >= 0 else ''
+        if self._gpio_reset_path:
+            open('/sys/class/gpio/export', 'w').write(str(gpio))
+            open(f'/sys/class/gpio/gpio{gpio}/direction', 'w').write('high')
+        self._display = Display(pack_dir, printer['fb'], printer['mask'], slice_cache, printer['pixel'])
+        self._grbl = Grbl(printer['serial'], printer['baudrate'], self._comm_period * 5, self._comm_period)
+        self._preprocessor = Preprocessor(printer['pixel'])
+        self._exposure = ExposureScheduler(self._display, self._grbl)
+        self._journal = PrintJournal(printer['journal'] or pack_dir.rstrip('/') + '.journal', 30)
+        self._preload_lookahead = 0  # see probe.tune
+        self._slice_load_time = 0.0
+        self._benchmark_path = pack_dir.rstrip('/') + f'.{self._name}.benchmark.json'
+        self._benchmark: dict | None = None
+        try:
+            with open(self._benchmark_path) as f:
+                self._benchmark = json.load(f)
+            self._apply_tuning(self._benchmark['tuning'])
+        except (OSError, ValueError, KeyError):
+            pass  # not measured yet - keep the defaults
 
         # Runtime state
         self._commands: deque[str] = deque()
+        self._source: Iterator[str] | None = None  # streamed commands not yet added to the queue
+        self._source_name: str = ''
         self._immediate_command: str = ''
+        self._realtime_sent: deque[str] = deque()  # real-time commands sent by the API threads, not yet accounted
         self._await_response: bool = False
         self._holding: bool = False
         self._delay_end: float = 0.0
+        self._sync_seq: int = 0  # waiting for an Idle status report with at least this sequence number
+        self._layer: int = 0  # the layer being printed (from the preprocessor generated layer header)
+        self._print_stopped: bool = False  # the print was stopped by the operator (journal should not offer resume)
+        self._resume_info: dict | None = self._journal.load()
 
         # Misc
+        self._last_exposure: dict | None = None
+        self._latencies = deque(maxlen=100)  # measured real-time command latencies
+        self._trace: TraceRecorder | None = None
+        self._trace_dir = pack_dir.rstrip('/') + '.traces/'
         self._run_log = deque(maxlen=100)
         self._log_lock = Lock()
+        self._log_listeners: list[Callable[[dict], None]] = []
         self._run_thread_obj: Optional[Thread] = None
 
         # Start the command execution thread
@@ -54,17 +101,57 @@ class HwManager:
         self._await_response: bool = False
         self._holding: bool = False
         self._delay_end: float = 0.0
+        self._sync_seq: int = 0
+        self._grbl.set_poll_period(0.0)
+        self._exposure.abort()
+        self._source = None
+        self._print_stopped = True
         self._commands.clear()
 
-    def set_image_pack(self, image_pack_file_name: str):
-        """Selects an image pack archive. Empty line to clear."""
-        self._preprocessor.set_image_pack(f'{self._pack_dir}/{image_pack_file_name}')
+    def get_name(self) -> str:
+        """Get the printer name (see printers.py)."""
+        return self._name
+
+    def set_image_pack(self, image_pack_file_name: str, lit_areas: list[int] | None = None):
+        """Selects an image pack archive. Empty line to clear.
+        lit_areas - lit pixel counts of the pack images in index order (required by the area rules)."""
+        self._preprocessor.set_image_pack(f'{self._pack_dir}/{image_pack_file_name}', lit_areas)
         self._display.set_image_pack(image_pack_file_name)
 
     def get_image_pack(self) -> str:
         """Gets currently selected image pack archive. Empty line if none."""
         return self._display.get_image_pack()
 
+    def get_image_names(self) -> list[str]:
+        """Gets image names of the selected image pack in index order (the first one has index 1)."""
+        return self._preprocessor.get_image_names()
+
+    def get_image_count(self) -> int:
+        """Number of images in the selected image pack."""
+        return len(self._preprocessor.get_image_names())
+
+    def get_resume_info(self) -> dict | None:
+        """Get the interrupted print which can be resumed: {pack: str, layer: int, time: float} or None.
+        "layer" is the last completed layer."""
+        info = self._resume_info
+        return {'pack': info['pack'], 'layer': info['layer'], 'time': info['time']} if info else None
+
+    def resume_print(self, lit_areas: list[int] | None = None):
+        """Resume the interrupted print: restore its image pack and preprocessor config,
+        re-home, move to the retract height of the next layer and print from that layer (starting with a hold).
+        lit_areas - see set_image_pack."""
+        info = self._resume_info
+        if not info:
+            raise ValueError('There is no interrupted print to resume')
+        if self.is_busy():
+            raise ValueError('Printer busy')
+        self.set_image_pack(info['pack'], lit_areas)
+        self.preprocess(['@rule clear', '@layer clear', '@plate clear', '@transform clear'] + info['cfg'])
+        layer = info['layer'] + 1
+        safe_z = self._preprocessor.get_safe_z(layer)
+        self._log_add(f'Resuming {info["pack"]} from layer #{layer}')
+        self.add_commands(['$H', f'G0 Z{safe_z / 1000:.2f}', f'@print {layer}'])
+
     def get_preprocessor_cfg(self):
         """Get a list of configured preprocessor directives (rules, layers, supports, etc.)"""
         return self._preprocessor.get_cfg()
@@ -95,43 +182,135 @@ class HwManager:
             self._log_add(f'Failed to preprocess commands: {e}', e)
             raise e
 
-    def get_commands(self) -> List[str]:
-        """Get command queue contents."""
-        return list(self._commands)
-
-    def clear_commands(self, soft_reset=False):
-        """Clear the commands queue. Also send "^X" if soft_reset is True."""
+    def stream_file(self, file_name: str, member: str = ''):
+        """Queue the commands from a (potentially huge) gcode file in the pack dir or from a member of an archive.
+        The lines are read and preprocessed incrementally by the execution thread as the queue drains."""
+        self._ensure_running()
+        self._source_name = f'{file_name}/{member}' if member else file_name
+        self._source = read_lines(f'{self._pack_dir}/{file_name}', member)
+
+    def get_commands(self, limit: int | None = None) -> List[str]:
+        """Get command queue contents, at most limit first commands if set. A comment line is appended if more
+        commands are left out or streamed from a file."""
+        commands = self._commands
+        result = list(commands) if limit is None else list(islice(commands, limit))
+        if len(result) < len(commands):
+            result.append(f'; ... {len(commands) - len(result)} more')
+        if self._source:
+            result.append(f'; ... more from {self._source_name}')
+        return result
+
+    def get_queue_length(self) -> int:
+        """Number of commands in the queue (not counting the ones still to be streamed from a file)."""
+        return len(self._commands)
+
+    def is_busy(self) -> bool:
+        """True if there are commands in the queue (or streamed from a file)."""
+        return bool(self._commands) or self._source is not None
+
+    def clear_commands(self, soft_reset=False) -> float | None:
+        """Clear the commands queue. Also immediately send "^X" if soft_reset is True (returns its latency in ms)."""
+        start = time.perf_counter()
+        self._print_stopped = True
+        self._source = None
         self._commands.clear()
         if soft_reset and self._immediate_command != 'hwreset':
-            self._ensure_running()
-            self._immediate_command = 'reset'
+            return self._send_realtime('\x18', 'stop', start)
+        return None
 
-    def hard_stop(self):
-        """Immediately issue an HW reset to GRBL MCU."""
+    def hard_stop(self) -> float:
+        """Immediately issue an HW reset to GRBL MCU. Returns the latency of the reset GPIO write (ms)."""
+        start = time.perf_counter()
         self._reset_pin(0)
+        latency = self._add_latency('hardstop', start)
         self._ensure_running()
         self._immediate_command = 'hwreset'  # turn it off in the command loop
+        return latency
 
-    def hold(self):
-        """ASAP issue GRBL "!" hold command."""
-        self._ensure_running()
-        self._immediate_command = self._immediate_command or '!'
+    def hold(self) -> float:
+        """Immediately send GRBL "!" hold command. Returns the latency (ms), see _send_realtime."""
+        return self._send_realtime('!', 'hold', time.perf_counter())
 
-    def resume(self):
-        """ASAP issue GRBL "~" resume command."""
-        self._ensure_running()
-        self._immediate_command = self._immediate_command or '~'
+    def resume(self) -> float:
+        """Immediately send GRBL "~" resume command. Returns the latency (ms), see _send_realtime."""
+        return self._send_realtime('~', 'resume', time.perf_counter())
+
+    def get_latencies(self) -> list[dict]:
+        """Get the measured latencies of the recent real-time commands (from the call to the serial port transmission
+        or to the reset GPIO write): [{time, cmd, latency}] (latency in ms)."""
+        return list(self._latencies)
+
+    def add_log_listener(self, listener: Callable[[dict], None]):
+        """Register a callback receiving every new log entry. It is called from the adding thread, so it must be fast."""
+        self._log_listeners.append(listener)
 
     def get_log(self):
         """Get current command log contents."""
         with self._log_lock:
             return list(self._run_log)
 
+    def get_exposures(self) -> list[dict]:
+        """Get the measured exposure records of the recently printed layers (see ExposureScheduler)."""
+        return self._exposure.get_history()
+
     def get_grbl_state_line(self):
         """Get the latest received GRBL status line. "(EXPIRED)" is appended if it is unavailable for a while."""
         suffix = '' if self._grbl.get_state() else ' (EXPIRED)'
         return self._grbl.get_status_line() + suffix
 
+    def get_grbl_status(self) -> dict | None:
+        """Get the latest structured GRBL status (state, positions, feed, buffers, overrides, pins).
+        None if it is unavailable for a while."""
+        status = self._grbl.get_status()
+        return status.to_dict() if status else None
+
+    def get_grbl_settings(self) -> list[dict] | None:
+        """Get the cached GRBL settings: [{setting: int, value: string}] ordered by the setting number.
+        None if they are not read yet (they are read once GRBL is idle after a connection or reset)."""
+        settings = self._grbl.get_settings()
+        return [{'setting': n, 'value': v} for n, v in sorted(settings.items())] if settings is not None else None
+
+    def get_benchmark(self) -> dict | None:
+        """Get the report of the last "benchmark" command (None if never run): {time, pack, slices, slice_decode_ms,
+        slice_mask_ms, fb_write_ms, grbl_ok_ms, sd_read_mbps, tuning: {comm_period, preload_lookahead,
+        slice_load_time}}. Measurements which could not be done are None."""
+        return self._benchmark
+
+    def start_trace(self) -> str:
+        """Start recording the serial I/O, executed commands, display writes and delays to a new trace file
+        (see trace.py) in the traces dir next to the pack dir. Returns the trace file name."""
+        self.stop_trace()
+        os.makedirs(self._trace_dir, 0o755, exist_ok=True)
+        name = f'{self._name}.{time.strftime("%Y%m%d-%H%M%S")}.d7trace'  # names can not contain dots
+        trace = TraceRecorder(self._trace_dir + name)
+        settings = self._grbl.get_settings()  # a replay skips the same unchanged setting writes
+        trace.record(META, json.dumps({'printer': self._name, 'pack': self.get_image_pack(),
+                                       'settings': {str(n): v for n, v in sorted(settings.items())}
+                                       if settings is not None else None}))
+        self._grbl.set_trace(trace)
+        self._display.set_trace(trace)
+        self._trace = trace
+        self._log_add(f'Trace recording started: {name}')
+        return name
+
+    def stop_trace(self) -> dict | None:
+        """Stop recording the trace. Returns its info (see TraceRecorder.get_info) or None if not recording."""
+        trace = self._trace
+        if not trace:
+            return None
+        self._trace = None
+        self._grbl.set_trace(None)
+        self._display.set_trace(None)
+        trace.close()
+        info = trace.get_info()
+        self._log_add(f'Trace recording stopped: {info["records"]} records, {info["dropped"]} batches dropped')
+        return info
+
+    def get_trace_info(self) -> dict | None:
+        """Info of the trace being recorded (see TraceRecorder.get_info), None if not recording."""
+        trace = self._trace
+        return trace.get_info() if trace else None
+
     # PRIVATE Section
 
     def _ensure_running(self):
@@ -148,20 +327,130 @@ class HwManager:
 
         with self._log_lock:
             last_id = self._run_log[len(self._run_log) - 1]['id'] if self._run_log else 0
-            self._run_log.append({
+            entry = {
                 'id': last_id + 1,
                 'time': time.time(),
                 'msg': msg,
-            })
+            }
+            self._run_log.append(entry)
+
+        for listener in list(self._log_listeners):
+            listener(entry)
+
+    def _send_realtime(self, char: str, name: str, start: float) -> float:
+        """Send a GRBL real-time command straight to the serial port from the calling (API) thread, so it is delayed
+        neither by the execution loop sleep nor by an image decode in progress. The execution loop only updates its
+        state afterwards. If the port is not usable (closed after an error), the command is left to the execution loop
+        which reopens the port, the latency is then the time to hand it over. Returns the latency since start (ms)."""
+        self._ensure_running()
+        try:
+            self._grbl.send_realtime(char)
+        except SerialException as e:
+            if self._immediate_command != 'hwreset':  # a pending hardware reset supersedes it
+                self._immediate_command = char
+            self._log_add(f'{name} left to the command loop: {e}')
+            return self._add_latency(name, start)
+        self._realtime_sent.append(char)
+        if trace := self._trace:
+            trace.record(REALTIME, char)
+        return self._add_latency(name, start)
+
+    def _add_latency(self, name: str, start: float) -> float:
+        latency = round((time.perf_counter() - start) * 1000, 3)
+        self._latencies.append({'time': time.time(), 'cmd': name, 'latency': latency})
+        self._log_add(f'{name} sent in {latency}ms')
+        return latency
+
+    def _run_benchmark(self):
+        """Measure this unit (slice decode and mask for the active pack, frame buffer write, GRBL "ok" round trip,
+        SD card read), store the report next to the pack dir and apply the derived settings (see probe.tune).
+        Blocks the execution loop for a few seconds."""
+        self._log_add('Benchmark started')
+        report = {'time': time.time(), 'pack': self.get_image_pack(), 'slices': 0, 'slice_decode_ms': None,
+                  'slice_mask_ms': None, 'fb_write_ms': None, 'grbl_ok_ms': None, 'sd_read_mbps': None}
+
+        def ms(values: list[float]) -> float:
+            return round(statistics.median(values) * 1000, 3)
+
+        names = self._preprocessor.get_image_names() if report['pack'] else []
+        if names:  # a few slices spread over the pack
+            samples = [self._display.measure_load(names[i * (len(names) - 1) // 4]) for i in range(min(5, len(names)))]
+            report.update(slices=len(samples), slice_decode_ms=ms([s[0] for s in samples]),
+                          slice_mask_ms=ms([s[1] for s in samples]))
+        report['fb_write_ms'] = ms(self._display.measure_write(10))
+        if round_trips := self._measure_grbl_ok(10):
+            report['grbl_ok_ms'] = ms(round_trips)
+        if report['pack']:
+            report['sd_read_mbps'] = measure_read(f'{self._pack_dir}/{report["pack"]}')
+
+        report['tuning'] = tune(report)
+        self._apply_tuning(report['tuning'])
+        self._benchmark = report
+        with open(self._benchmark_path, 'w') as f:
+            json.dump(report, f, indent=1)
+        self._log_add('Benchmark: ' + ', '.join(f'{k} {v}' for k, v in report.items() if k not in ('time', 'pack')))
+
+    def _measure_grbl_ok(self, count: int) -> list[float]:
+        """Round trips of "G4 P0" to its "ok" (s). Stops at the first one unanswered within a second."""
+        result = []
+        for _ in range(count):
+            start = time.perf_counter()
+            self._grbl.send('G4 P0\n')
+            while time.perf_counter() < start + 1:
+                lines = self._grbl.receive()
+                for line in lines:
+                    if not line.startswith('ok'):
+                        self._log_add(line)
+                if any(line.startswith(('ok', 'error')) for line in lines):
+                    result.append(time.perf_counter() - start)
+                    break
+                sleep(0.0005)
+            else:
+                self._log_add('GRBL did not answer, round trip not measured')
+                break
+        return result
+
+    def _apply_tuning(self, tuning: dict):
+        self._comm_period = tuning['comm_period']
+        self._grbl.set_state_request_periods(self._comm_period * 5, self._comm_period)
+        self._preload_lookahead = tuning['preload_lookahead']
+        self._slice_load_time = tuning['slice_load_time']
+
+    def _preload_ahead(self):
+        """Preload the next slice of the queue (up to _preload_lookahead commands ahead) while waiting for a delay
+        long enough to load it. Stops at the commands which use the preloaded slice or change the display."""
+        for index, raw_cmd in enumerate(islice(self._commands, self._preload_lookahead)):
+            lcmd = raw_cmd.partition(';')[0].strip().lower()
+            if lcmd.startswith('preload'):
+                self._display.preload(raw_cmd.partition(';')[0].strip()[7:].strip())
+                self._preload_support(index)
+                return
+            if lcmd.startswith(('slice', 'expose', 'blank', 'transform', 'benchmark')):
+                return
+
+    def _preload_support(self, index: int):
+        """Load the support image of the expose command following the preload at the given queue index (if any),
+        so it is not loaded while exposing."""
+        for raw_cmd in islice(self._commands, index + 1, index + SUPPORT_LOOKAHEAD):
+            cmd = raw_cmd.partition(';')[0].strip()
+            lcmd = cmd.lower()
+            if lcmd.startswith('expose'):
+                args = cmd[6:].split(maxsplit=2)  # expose_ms [support_ms support_image]
+                if len(args) > 2 and int(args[1]) > 0:
+                    self._exposure.preload_support(args[2])
+                return
+            if lcmd.startswith(('preload', 'slice', 'blank', 'transform', 'benchmark')):
+                return
 
     def _reset_pin(self, state):
-        open(self._gpio_reset_path, 'w').write('1' if state else '0')
+        if self._gpio_reset_path:  # not wired otherwise
+            open(self._gpio_reset_path, 'w').write('1' if state else '0')
 
     def _exec(self, raw_cmd: str, immediate=False) -> bool:
         """Executes the given command:
         Strips away comments.
         Dispatches the command to GRBL/Display/GPIO/System.
-        Handles software delay command.
+        Handles software delay, motion sync and exposure commands.
 
         If immediate is True the command is sent even when the system is in awaiting-response/hold/delay state.
 
@@ -171,10 +460,14 @@ class HwManager:
         cmd = raw_cmd.partition(';')[0].strip()
         lcmd = cmd.lower()
 
-        if lcmd.startswith('preload'):
+        if lcmd.startswith('preload') and not self._exposure.is_active():  # do not stretch the exposure
             self._display.preload(cmd[7:].strip())
+            if not immediate:  # executed from the queue head
+                self._preload_support(0)
         elif self._is_waiting() and not immediate:
             return False
+        elif layer := _LAYER_MARKER.match(raw_cmd):
+            self._start_layer(int(layer[1]))
         elif lcmd == 'reset' or '\x18' in cmd:
             self._grbl.send('\x18')
             self._reset_state()
@@ -195,20 +488,50 @@ class HwManager:
             self._display.blank()
         elif lcmd.startswith('slice'):
             self._display.show(cmd[5:].strip())
+        elif lcmd.startswith('transform'):
+            self._display.set_transform(cmd[9:].strip())
+        elif lcmd == 'benchmark':
+            self._run_benchmark()
         elif lcmd.startswith('delay'):
             millis = re.findall(r'[0-9]+', lcmd)
-            self._delay_end = time.time() + int(millis[0] if millis else 0) / 1000
+            self._delay_end = time.monotonic() + int(millis[0] if millis else 0) / 1000
+            if trace := self._trace:
+                trace.record_time(DELAY, self._delay_end)
+        elif lcmd.startswith('expose'):
+            if not self._grbl_accepts(cmd):
+                return False
+            args = cmd[6:].split(maxsplit=2)  # expose_ms [support_ms support_image]
+            self._exposure.start(int(args[0]), args[2] if len(args) > 2 else '', int(args[1]) if len(args) > 1 else 0)
+            self._await_response = True  # wait for M3 to be acknowledged (the exposure itself runs anyway)
+        elif lcmd == 'sync':
+            self._sync_seq = self._grbl.request_status()
+            self._grbl.set_poll_period(self._sync_period)  # notice the completion sooner than a G4 "ok" round trip
         elif lcmd:
-            state = self._grbl.get_state()
-            if state.startswith(('Alarm', 'Door', 'Sleep')) and not lcmd.startswith(('$', '#')):
-                return False  # Most likely in Alarm state and waiting for $H or $X.
-            if state.startswith('Halt') and cmd != '~':
-                return False  # Only immediate resume command allowed
-            self._grbl.send(cmd)
-            self._holding = cmd.rfind('!') > cmd.rfind('~')  # check that there was no "resume" after "hold"
-            if cmd not in ('?', '!', '~'):
-                self._grbl.send('\n')  # send a new line if it's not an immediate single-char command
+            if not self._grbl_accepts(cmd):
+                return False
+            if cmd.startswith('$') and '=' in cmd and not immediate and self._grbl.needs_settings():
+                self._grbl.read_settings()  # compare the setting write with the actual value, it is retried after "ok"
                 self._await_response = True
+                return False
+            if not immediate and self._grbl.is_setting_current(cmd):  # skip a setting write changing nothing
+                self._log_add(f'{cmd} unchanged, not written')
+            else:
+                self._grbl.send(cmd)
+                self._holding = cmd.rfind('!') > cmd.rfind('~')  # check that there was no "resume" after "hold"
+                if cmd not in ('?', '!', '~'):
+                    self._grbl.send('\n')  # send a new line if it's not an immediate single-char command
+                    self._await_response = True
+        if trace := self._trace:
+            trace.record(IMMEDIATE if immediate else EXEC, raw_cmd)
+        return True
+
+    def _grbl_accepts(self, cmd: str) -> bool:
+        """False if GRBL can not execute the command (or the M3 of an exposure) in its current state."""
+        state = self._grbl.get_state()
+        if state.startswith(('Alarm', 'Door', 'Sleep')) and not cmd.startswith(('$', '#')):
+            return False  # Most likely in Alarm state and waiting for $H or $X.
+        if state.startswith('Halt') and cmd != '~':
+            return False  # Only immediate resume command allowed
         return True
 
     # THREADING Section
@@ -220,34 +543,117 @@ class HwManager:
         # stop running only if a new instance is started (demon thread will be killed with the application)
         while os.path.getmtime(self._guard_file) == guard_time:
             try:
-                sleep(self._comm_period)  # a small delay executed while we are waiting for GRBL or a soft delay
+                sleep(self._sleep_time())  # a small delay executed while we are waiting for GRBL or a soft delay
                 self._run_loop()
             except Exception as e:  # log error, hold on for a second and try to start again
                 self._log_add(f'Execution error: {e}', e)
+                self._journal.close()  # keep the journal as is to allow resuming
+                self._resume_info = self._journal.load()
+                self._source = None
                 self._commands.clear()
                 sleep(1)
         self._log_add('Hw manager thread stopped by guard file')
         self._grbl.close()
 
+    def _read_source(self):
+        """Preprocess and queue the streamed lines until the queue holds enough commands to execute."""
+        source = self._source
+        while source and len(self._commands) < self._stream_queue_size:
+            line = next(source, None)
+            if line is None:
+                self._source = None
+                self._log_add(f'Finished reading {self._source_name}')
+                return
+            self._commands.extend(self._preprocessor.preprocess_line(line))
+
+    def _start_layer(self, layer: int):
+        """Journal the previous layer as completed (or start a new journal)."""
+        if not self._journal.is_active():
+            self._journal.start(self.get_image_pack(), self._preprocessor.get_cfg())
+            self._print_stopped = False
+            self._resume_info = None
+        elif self._layer:
+            self._journal.layer_done(self._layer)
+        self._layer = layer
+
+    def _sleep_time(self) -> float:
+        """Sleep for the regular communication period (shorter while waiting for "sync"),
+        but wake up in time for the nearest delay or exposure end."""
+        now = time.monotonic()
+        period = self._sync_period if self._sync_seq else self._comm_period
+        deadlines = [d for d in (self._delay_end, self._exposure.get_deadline()) if d > now]
+        if not deadlines:
+            return period
+        return max(min(period, min(deadlines) - now), 0.0)
+
     def _is_waiting(self):
-        return self._await_response or self._holding or self._delay_end > time.time()
+        return (self._await_response or self._holding or self._delay_end > time.monotonic() or self._sync_seq > 0
+                or self._exposure.is_active())
 
     def _run_loop(self):
-        # First - read GRBL's output.
+        # First - fire the due exposure steps as they are time-critical
+        self._exposure.poll()
+        if (last := self._exposure.get_last()) and last is not self._last_exposure:  # exposure just finished
+            self._last_exposure = last
+            self._await_response = True  # wait for M5 to be acknowledged
+            self._log_add(f'Exposure {last["expose"]}ms: {last["actual"]}ms'
+                          + (f', support {last["support"]}ms: {last["support_actual"]}ms' if last['support'] else ''))
+
+        # Second - read GRBL's output.
+        failed_exposure = None
         for line in self._grbl.receive():
             self._log_add(line)  # Log anything it sends us (except status lines, they are intercepted by Grbl.py)
             if line.startswith(('ok', 'error')):
                 self._await_response = False  # Got our response
+                if failed := self._exposure.acknowledge(line):
+                    failed_exposure = self._last_exposure = failed
             if line.startswith('error'):  # It's an error. Enter a hold state just in case.
                 self._exec('!', True)
+        if failed_exposure:  # the layer is not complete - stop the print (keeping the journal to resume from it)
+            raise RuntimeError(f'Exposure of {failed_exposure["image"]} failed, GRBL rejected M3')
+
+        # Check for the motion completion if requested by "sync"
+        if self._sync_seq:
+            status = self._grbl.get_status()
+            if status and status.seq >= self._sync_seq and status.state == 'Idle':
+                self._sync_seq = 0
+                self._grbl.set_poll_period(0.0)
 
-        # Second - send an immediate command if present
+        # Third - send an immediate command if present
         if self._immediate_command:
             self._exec(self._immediate_command, True)
             self._immediate_command = ''
-
-        # Third - send commands until we hit a delay or something that requires a response from GRBL
+        # and account for the real-time commands already sent by the API threads
+        while self._realtime_sent:
+            char = self._realtime_sent.popleft()
+            if char == '\x18':
+                self._reset_state()
+            else:
+                self._holding = char == '!'
+
+        # Read the GRBL settings once it is idle after a connection or reset
+        if (self._grbl.needs_settings() and not self.is_busy() and not self._is_waiting()
+                and self._grbl.get_state() in ('Idle', 'Alarm')):
+            self._grbl.read_settings()
+            self._await_response = True
+
+        # Fourth - refill the queue from the streamed source
+        self._read_source()
+
+        # Fifth - send commands until we hit a delay or something that requires a response from GRBL
         while self._commands and self._exec(cmd := self._commands[0]):
             self._log_add(f'> {cmd}')
             if self._commands:
                 self._commands.popleft()
+
+        # Use the rest of a long delay to load the next slice, if it is slow to load on this unit
+        if (self._preload_lookahead and not self._exposure.is_active()
+                and self._delay_end - time.monotonic() > self._slice_load_time):
+            self._preload_ahead()
+
+        # Finally - close the print journal when the queue is over and its last commands are complete (acknowledged)
+        if self._journal.is_active() and not self.is_busy() and (self._print_stopped or not self._is_waiting()):
+            if not self._print_stopped:
+                self._journal.layer_done(self._layer)
+            self._journal.finish(self._print_stopped)
+            self._resume_info = None
@@ -42,6 +42,10 @@ class ImageMapper:
                             self._image_names.append(tag.text.strip())
                     break
 
+    def get_image_names(self) -> list[str]:
+        """Gets image names of the current pack in index order (the first one has index 1)."""
+        return self._image_names[1:]
+
     def get_layer_specs(self) -> list[str]:
         """Gets a list of string-formatted height to image index mappings for the main layer images. (See Format.md)"""
         return [lr.spec for lr in self._layers]
@@ -0,0 +1,72 @@
+import json
+import os
+import time
+
+
+class PrintJournal:
+    """Append-only crash-safe journal of the current print: the image pack, the preprocessor config
+    and the last completed layer. Records are JSON lines written right away (cheap page cache writes),
+    but synced to the SD card at most once per sync_period to avoid hammering it.
+    A new print truncates the journal, so it never grows beyond a single print."""
+
+    def __init__(self, path: str, sync_period: float):
+        self._path = path
+        self._sync_period = sync_period
+        self._file = None
+        self._last_sync = 0.0
+
+    def load(self) -> dict | None:
+        """Read the journal left by the previous run. Returns {pack, cfg, layer, time} if that print was interrupted
+        (neither finished nor stopped) after completing at least one layer, None otherwise."""
+        result = None
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # torn write of the very last record
+                        break
+                    if record['event'] == 'start':
+                        result = {'pack': record['pack'], 'cfg': record['cfg'], 'layer': 0, 'time': record['time']}
+                    elif record['event'] == 'layer' and result:
+                        result['layer'] = record['layer']
+                        result['time'] = record['time']
+                    elif record['event'] in ('end', 'stop'):
+                        result = None
+        except FileNotFoundError:
+            return None
+        return result if result and result['layer'] > 0 else None
+
+    def is_active(self) -> bool:
+        """True if a print is being journaled."""
+        return self._file is not None
+
+    def start(self, pack: str, cfg: list[str]):
+        """Start a new journal for a print of the given pack with the given preprocessor config."""
+        self.close()
+        self._file = open(self._path, 'w')
+        self._write({'event': 'start', 'pack': pack, 'cfg': cfg}, True)
+
+    def layer_done(self, layer: int):
+        """Record the layer as completed."""
+        if self._file:
+            self._write({'event': 'layer', 'layer': layer}, False)
+
+    def finish(self, stopped: bool):
+        """Record the end of the print (finished normally or stopped by the operator) and close the journal."""
+        if self._file:
+            self._write({'event': 'stop' if stopped else 'end'}, True)
+            self.close()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _write(self, record: dict, sync: bool):
+        record['time'] = time.time()
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if sync or time.monotonic() > self._last_sync + self._sync_period:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
@@ -0,0 +1,85 @@
+import re
+from itertools import zip_longest
+from zipfile import ZipFile
+
+from d7print.image_mapper import ImageMapper
+
+PIXEL_SIZE = 0.04725  # default screen pixel pitch in mm (LS055R1SX04), see the "pixel" printer config key
+
+# A part of a composed slice name: [pack:]image[@dx,dy] (offset in pixels, the current pack if there is no pack)
+_PART = re.compile(r'(?:(?P<pack>[^:|]+):)?(?P<image>[^@|]+)(?:@(?P<dx>-?[0-9]+),(?P<dy>-?[0-9]+))?')
+
+
+class PlatePack:
+    """An additional image pack printed on the same build plate as the current one, shifted by an XY offset.
+    Its layers are mapped by the @layer and @support directives of its own MAPFILE script (other directives are
+    ignored - the rules of the current config apply to the whole plate). See Format.md for the @plate directive."""
+
+    def __init__(self, spec: str, pack_dir: str, pixel_size: float = PIXEL_SIZE):
+        self.spec = spec
+        spec_list = spec.split()
+        self.name = spec_list.pop(0)
+        self.dx = 0  # offset in pixels: x - screen columns to the right, y - rows down
+        self.dy = 0
+        for arg, val in zip_longest(spec_list[::2], spec_list[1::2]):
+            if arg.lower() == 'x':
+                self.dx = round(float(val) / pixel_size)
+            elif arg.lower() == 'y':
+                self.dy = round(float(val) / pixel_size)
+            else:
+                raise ValueError(f'Unknown argument: {arg}')
+
+        self._mapper = ImageMapper()
+        path = f'{pack_dir}/{self.name}'
+        self._mapper.set_image_pack(path)
+        lines = []
+        with ZipFile(path) as zf:
+            if scripts := [n for n in zf.namelist() if n.lower().endswith('.gcode')]:
+                with zf.open(scripts[0]) as gcode:  # the first script, as for the current pack
+                    lines = [str(line, 'utf8') for line in gcode.readlines()]
+        if not lines or not lines[0].strip().lower().startswith('mapfile'):
+            raise ValueError(f'{self.name} has no MAPFILE script with the layer mapping')
+        for line in lines[1:]:
+            directive, _, args = line.partition(';')[0].strip().partition(' ')
+            if directive.lower() == '@layer':
+                if args.strip().lower() == 'clear':
+                    self._mapper.clear()
+                else:
+                    self._mapper.add_layer(args)
+            elif directive.lower() == '@support':
+                self._mapper.add_support(args)
+
+    def get_layer(self, z: int) -> str | bool:
+        """Composed name part of the main layer image for the given height. False if the pack has no more layers."""
+        return self._part(self._mapper.get_layer(z))
+
+    def get_support(self, z: int) -> str | bool:
+        """Composed name part of the support image for the given height. False if there are no more supports."""
+        return self._part(self._mapper.get_support(z))
+
+    def _part(self, image: str | bool) -> str | bool:
+        return image and f'{self.name}:{image}@{self.dx},{self.dy}'
+
+
+def compose_name(parts: list[str | bool]) -> str | bool:
+    """Join the current pack image and the plate pack name parts into a composed slice name ("a.png|b.zip:c.png@5,0").
+    The images missing at this height (False) are left out. False if nothing is left."""
+    if not any(parts[1:]):
+        return parts[0]
+    return '|'.join(p or '' for p in parts)
+
+
+def is_composed(image_name: str) -> bool:
+    return '|' in image_name
+
+
+def parse_name(image_name: str) -> list[tuple[str, str, int, int]]:
+    """Split a composed slice name into (pack, image, dx, dy) parts. Pack is empty for the current pack."""
+    result = []
+    for part in image_name.split('|'):
+        if not part:
+            continue
+        if not (m := _PART.fullmatch(part)):
+            raise ValueError(f'Bad composed slice part: {part}')
+        result.append((m['pack'] or '', m['image'], int(m['dx'] or 0), int(m['dy'] or 0)))
+    return result
@@ -1,28 +1,60 @@
+import os
 from time import time
 
 from d7print.image_mapper import ImageMapper
+from d7print.plate import PIXEL_SIZE, PlatePack, compose_name
+from d7print.resample import SliceTransform
 from d7print.ruleset import Ruleset
 
 
 class Preprocessor:
     """Rule-based G-code generator.
     Creates a flexible model printing program based on a set of rules specifying speeds, timings and layer images
-    depending on printing position. See Format.md for the details on rule and layer specification."""
+    depending on printing position. See Format.md for the details on rule and layer specification.
+    pixel_size is the screen pixel pitch (mm) of the printer."""
 
-    def __init__(self):
+    def __init__(self, pixel_size: float = PIXEL_SIZE):
         self._image_mapper: ImageMapper = ImageMapper()
         self._ruleset: Ruleset = Ruleset()
         self._cfg_version = 1  # increment this value when a new rule is added
+        self._sync_mode = 'g4'  # how to wait for the feed-down completion: G4 round trip or GRBL status polling
+        self._lit_areas: dict[str, int] | None = None  # image name -> lit area (1/1000 mm²), None if unknown
+        self._pack_dir = ''
+        self._pixel_size = pixel_size
+        self._plate: list[PlatePack] = []  # packs printed together with the current one
+        self._transform = SliceTransform('', pixel_size)  # mapping of the slices to the screen
+        self._ruleset.set_area_source(self._get_lit_area)
 
-    def set_image_pack(self, image_pack_path: str):
+    def set_image_pack(self, image_pack_path: str, lit_areas: list[int] | None = None):
+        """Set the image pack. lit_areas are the lit pixel counts of the pack images in index order
+        (see PackCatalog.get_lit_areas), they are required by the area rules."""
+        self._lit_areas = None
+        self._pack_dir = os.path.dirname(image_pack_path)
         self._image_mapper.set_image_pack(image_pack_path)
+        if lit_areas is not None:
+            names = self._image_mapper.get_image_names()
+            if len(lit_areas) != len(names):
+                raise ValueError(f'Got lit areas of {len(lit_areas)} images, but the pack has {len(names)}')
+            self._lit_areas = dict((n, round(px * self._pixel_size ** 2 * 1000)) for n, px in zip(names, lit_areas))
+
+    def get_image_names(self) -> list[str]:
+        """Returns image names of the current pack in index order (the first one has index 1)."""
+        return self._image_mapper.get_image_names()
+
+    def get_safe_z(self, layer: int) -> int:
+        """Returns the retracted platform position of the given layer (micrometers)."""
+        rule = self._ruleset.get_layer_rule(layer)
+        return rule.z + rule.get('hr')
 
     def get_cfg(self) -> list[str]:
         """Returns a list of all rules, layers and supports in text format."""
-        result = []
+        result = [f'@sync {self._sync_mode}']
         result.extend('@rule ' + x for x in self._ruleset.get_rule_specs())
         result.extend('@layer ' + x for x in self._image_mapper.get_layer_specs())
         result.extend('@support ' + x for x in self._image_mapper.get_support_specs())
+        result.extend('@plate ' + p.spec for p in self._plate)
+        if self._transform.spec:
+            result.append('@transform ' + self._transform.spec)
         return result
 
     def get_cfg_version(self):
@@ -56,6 +88,21 @@ class Preprocessor:
                 else:
                     self._ruleset.add_rule(args)  # ruleset will parse the args
                 self._cfg_version += 1
+            elif dl == '@plate':
+                if args.strip().lower() == 'clear':
+                    self._plate.clear()
+                else:
+                    self._plate.append(PlatePack(args.strip(), self._pack_dir, self._pixel_size))
+                self._cfg_version += 1
+            elif dl == '@transform':
+                self._transform = SliceTransform('' if args.strip().lower() == 'clear' else args, self._pixel_size)
+                self._cfg_version += 1
+            elif dl == '@sync':
+                mode = args.strip().lower()
+                if mode not in ('g4', 'status'):
+                    raise ValueError(f'Unknown sync mode "{mode}"')
+                self._sync_mode = mode
+                self._cfg_version += 1
             elif dl == '@print':
                 result.extend(self._print(args))  # output the printing program
             elif dl == '@preview':
@@ -66,6 +113,23 @@ class Preprocessor:
         except Exception as e:
             raise ValueError(f'Failed to preprocess {line}: {e}')
 
+    def _get_lit_area(self, z: int) -> int | None:
+        if any(p.get_layer(z) for p in self._plate):  # lit areas of the plate packs are not known
+            return None
+        image = self._image_mapper.get_layer(z)
+        if not image:  # nothing to expose
+            return 0
+        if self._lit_areas is None or image not in self._lit_areas:
+            return None
+        return round(self._lit_areas[image] * self._transform.get_area_scale())
+
+    def _get_layer(self, z: int) -> str | bool:
+        """Main layer image of the whole plate (a composed name if plate packs are used, see plate.py)."""
+        return compose_name([self._image_mapper.get_layer(z)] + [p.get_layer(z) for p in self._plate])
+
+    def _get_support(self, z: int) -> str | bool:
+        return compose_name([self._image_mapper.get_support(z)] + [p.get_support(z) for p in self._plate])
+
     def _print(self, args) -> list[str]:
         """Generate the printing program. The only parameter is the starting layer number (starting from 1)."""
         try:
@@ -77,29 +141,31 @@ class Preprocessor:
 
         try:
             result = ['! ; HOLD before printing']  # Always pause before actually printing
+            result.append(f'transform {self._transform.spec}'.rstrip())  # map the slices to the screen (or reset)
             while True:  # repeat until there are more layers to print
                 rule = self._ruleset.get_layer_rule(layer)
-                image = self._image_mapper.get_layer(rule.z)
-                support = self._image_mapper.get_support(rule.z)
+                image = self._get_layer(rule.z)  # a pack which has no more layers drops out of the plate
+                support = self._get_support(rule.z)
                 if image is False:
                     return result
 
                 result.append(f';###### Layer {layer} @ {rule.z / 1000:.2f}mm #####')
                 for z, f in rule.build_feed_down():  # add feed-down commands (multiple for decelerated movement)
                     result.append(f'G1 F{f} Z{z / 1000:.2f}')
-                # Pause to allow resin to escape. Prefer G4 to delay because of perfect sync with the previous G1.
-                result.append(f'G4 P{rule.time_before / 1000:.1f}')
-                result.append(f'preload {image}')  # preload the image while moving and waiting
-                result.append(f'slice')  # display it after the wait is over
-                result.append(f'M3')  # LED on
-                # Wait for the layer exposure.
-                # Prefer delay to G4 because M3 will resul in a wait for ok response.
-                result.append(f'delay {rule.time_expose}')
+                if self._sync_mode == 'status':
+                    result.append('sync')  # wait for GRBL to report Idle after the feed-down
+                    result.append(f'preload {image}')  # preload the image while moving
+                    result.append(f'delay {rule.time_before}')  # pause to allow resin to escape
+                else:
+                    # Pause to allow resin to escape. Prefer G4 to delay because of perfect sync with the previous G1.
+                    result.append(f'G4 P{rule.time_before / 1000:.1f}')
+                    result.append(f'preload {image}')  # preload the image while moving and waiting
+                # Display the image after the wait is over, turn the LED on, optionally switch to the support image
+                # and turn the LED off. Timed precisely by the exposure scheduler rather than by separate commands.
                 if support and rule.time_support > 0:
-                    result.append(f'preload {support}')  # preload the support image during the delay
-                    result.append(f'slice')  # display it immediately after the delay
-                    result.append(f'delay {rule.time_support}')  # wait for support exposure period
-                result.append(f'M5')  # LED off
+                    result.append(f'expose {rule.time_expose} {rule.time_support} {support}')
+                else:
+                    result.append(f'expose {rule.time_expose}')
                 result.append(f'delay {rule.time_after}')  # wait for the resin to stabilize
                 for z, f in rule.build_feed_up():  # add feed-up commands (multiple for accelerated movement)
                     result.append(f'G1 F{f} Z{z / 1000:.2f}')
@@ -0,0 +1,96 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from zipfile import ZipFile
+
+import numpy as np
+from PIL import Image
+
+from d7print.plate import PIXEL_SIZE
+from d7print.resample import SliceTransform
+
+FORMATS = {'png': 'image/png', 'webp': 'image/webp'}
+DEFAULT_MASK = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mask.png')
+
+_worker_masks: dict[tuple[str, float], np.ndarray] = {}  # (mask path, mtime) -> mask, loaded once per worker process
+_worker_transforms: dict[tuple[str, float], SliceTransform] = {}  # (spec, pixel size) -> transform with its maps
+
+
+class PreviewRenderer:
+    """Renders downscaled slice previews in a separate lowest-priority process, so they never compete
+    with the hardware thread for the GIL. Results are kept in an on-disk LRU cache keyed by pack hash and slice.
+    A slice is shown as the printer would: mapped to its screen by the SliceTransform of the printer (the screen
+    size is the size of its mask) and optionally masked with its mask."""
+
+    def __init__(self, cache_dir: str, max_cache_bytes: int):
+        self._cache_dir = cache_dir
+        self._max_cache_bytes = max_cache_bytes
+        self._lock = Lock()
+        os.makedirs(cache_dir, 0o755, exist_ok=True)
+        self._executor = ProcessPoolExecutor(1, multiprocessing.get_context('forkserver'), initializer=os.nice,
+                                             initargs=(19,))
+
+    def get(self, pack_path: str, pack_hash: str, index: int, image_name: str, width: int, mask: bool,
+            fmt: str, mask_path: str = '', transform: str = '', pixel_size: float = PIXEL_SIZE) -> str:
+        """Get the path to a cached preview of the image, render it if necessary.
+        mask_path, transform (@transform spec) and pixel_size describe the printer screen, see the printer config.
+        If the pack hash is not known yet (e.g. not cataloged) a hash of its path, size and mtime is used instead."""
+        if fmt not in FORMATS:
+            raise ValueError(f'Unsupported preview format: {fmt}')
+        if not pack_hash:
+            st = os.stat(pack_path)
+            pack_hash = hashlib.sha256(f'{pack_path}|{st.st_size}|{st.st_mtime}'.encode()).hexdigest()
+        mask_path = mask_path or DEFAULT_MASK
+        screen = f'{mask_path}|{os.path.getmtime(mask_path)}|{transform}|{pixel_size}'
+        screen_hash = hashlib.sha256(screen.encode()).hexdigest()[:16]
+        path = os.path.join(self._cache_dir, f'{pack_hash}_{index}_{width}_{screen_hash}{"_m" if mask else ""}.{fmt}')
+        if os.path.exists(path):
+            os.utime(path)  # LRU: the last used entries have the latest mtime
+            return path
+
+        self._executor.submit(_render, pack_path, image_name, width, mask, fmt, path, mask_path, transform,
+                              pixel_size).result(timeout=60)
+        self._evict()
+        return path
+
+    def _evict(self):
+        """Remove the least recently used previews until the cache fits the size limit."""
+        with self._lock:
+            entries = [(e.stat(), e.path) for e in os.scandir(self._cache_dir) if e.is_file()]
+            total = sum(st.st_size for st, _ in entries)
+            for st, path in sorted(entries, key=lambda x: x[0].st_mtime):
+                if total <= self._max_cache_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= st.st_size
+
+
+def _get_mask(mask_path: str) -> np.ndarray:
+    key = (mask_path, os.path.getmtime(mask_path))
+    if (mask := _worker_masks.get(key)) is None:
+        with Image.open(mask_path) as m:
+            mask = _worker_masks[key] = np.array(m.getchannel(0), dtype='uint8')
+    return mask
+
+
+def _render(pack_path: str, image_name: str, width: int, mask: bool, fmt: str, out_path: str, mask_path: str,
+            transform: str, pixel_size: float):
+    with ZipFile(pack_path) as zf, zf.open(image_name) as zi, Image.open(zi) as img:
+        data = np.array(img.getchannel(0), dtype='uint8')
+    screen_mask = _get_mask(mask_path)
+    if transform:  # without a transform slices of other sizes are shown as they are (and not masked)
+        if (slice_transform := _worker_transforms.get((transform, pixel_size))) is None:
+            slice_transform = _worker_transforms[(transform, pixel_size)] = SliceTransform(transform, pixel_size)
+        data = slice_transform.apply(data, screen_mask.shape)
+    if mask and data.shape == screen_mask.shape:
+        data = (np.multiply(data, screen_mask, dtype='uint16') // 255).astype('uint8')
+    preview = Image.fromarray(data, 'L')
+    preview.thumbnail((width, width * data.shape[0] // max(data.shape[1], 1)), Image.Resampling.BOX)
+    tmp_path = out_path + '.tmp'
+    preview.save(tmp_path, fmt)
+    os.replace(tmp_path, out_path)  # never serve a half-written file
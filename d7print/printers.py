@@ -0,0 +1,50 @@
+import json
+import re
+
+CONFIG_PATH = '/etc/d7print.json'
+
+# Hardware of the original single printer setup (see README.md)
+DEFAULT_PRINTER = {
+    'name': 'd7',
+    'serial': '/dev/ttyS3',  # GRBL serial port
+    'baudrate': 115200,
+    'fb': '/dev/fb0',  # LCD frame buffer device
+    'mask': '',  # screen mask image, empty - d7print/mask.png
+    'pixel': 0.04725,  # screen pixel pitch (mm)
+    'gpio': 7,  # GRBL MCU reset GPIO number, -1 - not wired
+    'guard': '/var/run/d7print.guard',  # stops the execution thread of a previous instance
+    'journal': '',  # print journal, empty - next to the pack dir
+    'socket': '',  # hardware daemon socket, empty - run HwManager in the web app process
+}
+
+
+def load_printers(path: str, pack_dir: str) -> list[dict]:
+    """Load the printer configs from a JSON file: {"printers": [{"name": "d7", "serial": "/dev/ttyS3", ...}, ...]}.
+    Missing keys are taken from DEFAULT_PRINTER, the guard and journal files of every printer but the first one
+    get the printer name as a suffix. A single default printer is returned if the file does not exist."""
+    try:
+        with open(path) as f:
+            entries = json.load(f)['printers']
+    except FileNotFoundError:
+        entries = [{}]
+    if not entries:
+        raise ValueError(f'No printers configured in {path}')
+
+    result = []
+    for i, entry in enumerate(entries):
+        printer = {**DEFAULT_PRINTER, **entry}
+        if i and 'name' not in entry:
+            printer['name'] = f'{DEFAULT_PRINTER["name"]}_{i + 1}'
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', printer['name']):
+            raise ValueError(f'Bad printer name: {printer["name"]}')
+        if i and 'guard' not in entry:
+            printer['guard'] = f'/var/run/d7print.{printer["name"]}.guard'
+        if i and 'journal' not in entry:
+            printer['journal'] = pack_dir.rstrip('/') + f'.{printer["name"]}.journal'
+        result.append(printer)
+
+    names = [p['name'] for p in result]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Duplicate printer names in {path}')
+    return result
+
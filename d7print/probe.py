@@ -0,0 +1,34 @@
+import os
+import time
+
+MIN_COMM_PERIOD = 0.01  # the execution loop never polls faster (s)
+MAX_COMM_PERIOD = 0.05  # the original hard-coded period (s)
+PRELOAD_LOOKAHEAD = 64  # queued commands searched for the next preload while waiting (when slices are slow to load)
+
+
+def measure_read(path: str, limit: int = 64 << 20) -> float | None:
+    """Sequential read throughput of the file (MB/s) bypassing the page cache (dropped first), up to limit bytes.
+    None if nothing could be read."""
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        start = time.perf_counter()
+        total = 0
+        while total < limit and (block := f.read(1 << 20)):
+            total += len(block)
+        elapsed = time.perf_counter() - start
+    return round(total / elapsed / 1e6, 1) if total and elapsed > 0 else None
+
+
+def tune(report: dict) -> dict:
+    """Derive the execution settings from a benchmark report:
+    comm_period - the execution loop and fast status polling period (s), about one GRBL "ok" round trip:
+    polling faster only spins, polling slower delays every command;
+    preload_lookahead - how far the queue is searched for the next slice to preload during a long enough delay,
+    used only if loading a slice takes longer than a polling period (otherwise it is hidden by the moves anyway)."""
+    ok_ms = report.get('grbl_ok_ms')
+    comm_period = MAX_COMM_PERIOD if ok_ms is None else min(max(ok_ms / 1000, MIN_COMM_PERIOD), MAX_COMM_PERIOD)
+    slice_ms = (report.get('slice_decode_ms') or 0) + (report.get('slice_mask_ms') or 0)
+    return {'comm_period': round(comm_period, 3),
+            'preload_lookahead': PRELOAD_LOOKAHEAD if slice_ms / 1000 > comm_period else 0,
+            'slice_load_time': round(slice_ms / 1000, 3)}
@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    """Statistical profiler of all the threads of the process (hw_run, Flask handlers, catalog, etc.).
+    A separate thread samples their stacks every interval for a limited time window. Nothing runs while it is stopped,
+    so there is no overhead outside the window. The result is aggregated into collapsed stacks
+    ("thread;function (file:line);... count" lines) accepted by flame graph tools (flamegraph.pl, speedscope)."""
+
+    def __init__(self, interval: float = 0.005):
+        self._interval = interval
+        self._stacks: Counter[tuple[str, ...]] = Counter()
+        self._samples = 0
+        self._started = 0.0
+        self._stop_time = 0.0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def start(self, duration: float):
+        """Discard the previous results and sample for the given number of seconds (restarts the window if running)."""
+        with self._lock:
+            self._stacks.clear()
+            self._samples = 0
+            self._started = time.time()
+            self._stop_time = time.monotonic() + duration
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Stop sampling now, the results are kept."""
+        with self._lock:
+            self._stop_time = 0.0
+            thread = self._thread
+        if thread:
+            thread.join()
+
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def get_result(self) -> dict:
+        """Get the results: {running: bool, started: float, samples: int, interval: float, stacks: [string]}.
+        Stacks are collapsed stack lines, the most frequent first."""
+        with self._lock:
+            stacks = [f'{";".join(stack)} {count}' for stack, count in self._stacks.most_common()]
+            return {'running': self.is_running(), 'started': self._started, 'samples': self._samples,
+                    'interval': self._interval, 'stacks': stacks}
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            with self._lock:
+                if time.monotonic() >= self._stop_time:  # decided under the lock, so start() never misses a window
+                    self._thread = None
+                    return
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_id:
+                        self._stacks[(names.get(thread_id, str(thread_id)),) + self._collapse(frame)] += 1
+                self._samples += 1
+            time.sleep(self._interval)
+
+    @staticmethod
+    def _collapse(frame) -> tuple[str, ...]:
+        """Stack of the frame as a tuple of 'function (file:line)' labels, the outermost call first."""
+        result = []
+        while frame:
+            code = frame.f_code
+            result.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        result.reverse()
+        return tuple(result)
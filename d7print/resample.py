@@ -0,0 +1,168 @@
+import math
+from itertools import zip_longest
+
+import numpy as np
+
+from d7print.plate import PIXEL_SIZE
+
+
+class SliceTransform:
+    """Maps pack images of any resolution onto the screen: mirror, rotate clockwise, scale and shift (in this order),
+    the image center is placed at the screen center plus the offset. Nearest neighbour sampling.
+    A gather index map (a source pixel for every screen pixel) is computed once per source image shape,
+    so a slice is transformed with a single vectorized take. Transforms which only mirror, rotate by right angles
+    and shift pixels of the screen size (no scaling) skip the gather: the image is reoriented as a numpy view
+    and copied as a block. See Format.md for the @transform directive.
+    screen_pixel is the screen pixel pitch (mm), also the default source pixel size."""
+
+    def __init__(self, spec: str = '', screen_pixel: float = PIXEL_SIZE):
+        self.spec = ' '.join(spec.split())
+        spec_list = spec.lower().split()
+        self._screen_pixel = screen_pixel
+        self._pixel = screen_pixel  # source pixel size (mm)
+        self._scale = 1.0
+        self._dx = 0.0  # offset (mm): x - to the right, y - down the screen
+        self._dy = 0.0
+        self._rotate = 0.0  # degrees clockwise
+        self._mirror = ''  # h - left to right, v - top to bottom
+        for arg, val in zip_longest(spec_list[::2], spec_list[1::2]):
+            if val is None:
+                raise ValueError(f'Missing value of {arg}')
+            if arg == 'p':
+                self._pixel = float(val)
+            elif arg == 's':
+                self._scale = float(val)
+            elif arg == 'x':
+                self._dx = float(val)
+            elif arg == 'y':
+                self._dy = float(val)
+            elif arg == 'r':
+                self._rotate = float(val) % 360
+            elif arg == 'm':
+                if val not in ('h', 'v'):
+                    raise ValueError(f'Unknown mirror direction: {val}')
+                self._mirror = val
+            else:
+                raise ValueError(f'Unknown argument: {arg}')
+        if self._pixel <= 0 or self._scale <= 0:
+            raise ValueError('Pixel size and scale must be positive')
+        self._maps: dict[tuple, tuple] = {}  # (source shape, screen shape) -> maps
+
+    def is_identity(self) -> bool:
+        """True if the transform does not change screen-sized images (the gather step can be skipped)."""
+        return (self._pixel * self._scale == self._screen_pixel and not self._dx and not self._dy and not self._rotate
+                and not self._mirror)
+
+    def get_area_scale(self) -> float:
+        """Screen area of a source pixel in screen pixels."""
+        return (self._pixel * self._scale / self._screen_pixel) ** 2
+
+    def apply(self, img: np.ndarray, screen_shape: tuple[int, int]) -> np.ndarray:
+        """Transform a 2D 8-bit image to the screen shape. Raises ValueError if lit pixels fall off the screen."""
+        if self.is_identity() and img.shape == screen_shape:
+            return img
+        index, covered, outside, view = self._get_maps(img.shape, screen_shape)
+        flat = img.ravel()
+        if outside.size and flat[outside].any():
+            raise ValueError(f'Transformed {img.shape[1]}x{img.shape[0]} image is cut by the screen edge')
+        if view is not None:
+            return self._apply_view(img, view, screen_shape)
+        result = np.take(flat, index, mode='clip')  # the index is always in range, "clip" skips the bounds check
+        if covered is not None:
+            np.multiply(result, covered, out=result)
+        return result
+
+    @staticmethod
+    def _apply_view(img: np.ndarray, view: tuple[bool, int, int, int, int], screen_shape: tuple[int, int]) -> np.ndarray:
+        """Reorient the image as a view and copy the part covering the screen (see _get_view)."""
+        transpose, row_step, col_step, row0, col0 = view
+        oriented = (img.T if transpose else img)[::row_step, ::col_step]
+        if oriented.shape == screen_shape and not row0 and not col0:
+            return oriented  # a strided view, masking reads it directly
+        height, width = screen_shape
+        result = np.zeros(screen_shape, dtype=img.dtype)
+        top, bottom = max(-row0, 0), min(height, oriented.shape[0] - row0)
+        left, right = max(-col0, 0), min(width, oriented.shape[1] - col0)
+        if top < bottom and left < right:
+            result[top:bottom, left:right] = oriented[top + row0:bottom + row0, left + col0:right + col0]
+        return result
+
+    def _get_maps(self, shape: tuple[int, ...], screen_shape: tuple[int, int]) -> tuple:
+        """(gather index of the screen shape into the flattened source, 0/1 mask of the screen pixels covered by
+        the image or None if all are, flat indexes of the source pixels whose centers fall outside the screen,
+        view parameters or None - see _get_view; the index and the mask are None if the view is used).
+        Native-sized (intp) indexes are taken without a conversion on every call."""
+        key = (shape, screen_shape)
+        if (maps := self._maps.get(key)) is not None:
+            return maps
+        rows, cols = shape
+        height, width = screen_shape
+        angle = math.radians(self._rotate)
+        cos, sin = math.cos(angle), math.sin(angle)
+        if self._rotate % 90 == 0:  # exact right angles - no sampling jitter
+            cos, sin = round(cos), round(sin)
+        ratio = self._screen_pixel / (self._pixel * self._scale)  # source pixels per screen pixel
+
+        # screen pixel centers -> source pixel coordinates (inverse transform)
+        y = (np.arange(height, dtype='float32') + 0.5 - height / 2 - self._dy / self._screen_pixel)[:, None] * ratio
+        x = (np.arange(width, dtype='float32') + 0.5 - width / 2 - self._dx / self._screen_pixel)[None, :] * ratio
+        sx = x * cos + y * sin
+        sy = y * cos - x * sin
+        if self._mirror == 'h':
+            sx = -sx
+        elif self._mirror == 'v':
+            sy = -sy
+        src_col = np.floor(sx + cols / 2).astype('int32')
+        src_row = np.floor(sy + rows / 2).astype('int32')
+        if (view := self._get_view(src_row, src_col, shape)) is not None:
+            index = covered = None
+        else:
+            inside = (src_col >= 0) & (src_col < cols) & (src_row >= 0) & (src_row < rows)
+            index = np.where(inside, src_row * cols + src_col, 0).astype('intp')
+            covered = None if inside.all() else inside.astype('uint8')
+
+        # source pixel centers -> screen (forward transform) to find the pixels which would be lost
+        y = np.arange(rows, dtype='float32')[:, None] + 0.5 - rows / 2
+        x = np.arange(cols, dtype='float32')[None, :] + 0.5 - cols / 2
+        if self._mirror == 'h':
+            x = -x
+        elif self._mirror == 'v':
+            y = -y
+        screen_col = (x * cos - y * sin) / ratio + width / 2 + self._dx / self._screen_pixel
+        screen_row = (x * sin + y * cos) / ratio + height / 2 + self._dy / self._screen_pixel
+        lost = (screen_col < 0) | (screen_col >= width) | (screen_row < 0) | (screen_row >= height)
+        outside = np.flatnonzero(lost)
+
+        self._maps[key] = (index, covered, outside, view)
+        return index, covered, outside, view
+
+    @staticmethod
+    def _get_view(src_row: np.ndarray, src_col: np.ndarray, shape: tuple[int, ...]) -> tuple | None:
+        """If the source row and column of every screen pixel only step by one (mirror, right angle rotation
+        and shift at the screen pixel size): (transpose, row step, column step, row offset, column offset) such that
+        screen[i, j] = oriented[i + row offset, j + column offset] where oriented = (source or its transpose)
+        [::row step, ::column step]. None otherwise, also if the float mapping has jitter (checked exactly)."""
+        rows, cols = shape
+        height, width = src_row.shape
+        if height < 2 or width < 2:
+            return None
+        row_di, row_dj = int(src_row[1, 0] - src_row[0, 0]), int(src_row[0, 1] - src_row[0, 0])
+        col_di, col_dj = int(src_col[1, 0] - src_col[0, 0]), int(src_col[0, 1] - src_col[0, 0])
+        i = np.arange(height, dtype='int32')[:, None]
+        j = np.arange(width, dtype='int32')[None, :]
+        if not (np.array_equal(src_row, src_row[0, 0] + row_di * i + row_dj * j)
+                and np.array_equal(src_col, src_col[0, 0] + col_di * i + col_dj * j)):
+            return None
+        if abs(row_di) == 1 and not row_dj and not col_di and abs(col_dj) == 1:
+            transpose, row_step, col_step = False, row_di, col_dj
+            row0, col0 = int(src_row[0, 0]), int(src_col[0, 0])
+            size0, size1 = rows, cols
+        elif abs(col_di) == 1 and not col_dj and not row_di and abs(row_dj) == 1:  # screen rows are source columns
+            transpose, row_step, col_step = True, col_di, row_dj
+            row0, col0 = int(src_col[0, 0]), int(src_row[0, 0])
+            size0, size1 = cols, rows
+        else:
+            return None
+        # offsets in the flipped view: index k of a reversed axis is source index size - 1 - k
+        return (transpose, row_step, col_step,
+                row0 if row_step > 0 else size0 - 1 - row0, col0 if col_step > 0 else size1 - 1 - col0)
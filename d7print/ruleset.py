@@ -1,17 +1,19 @@
 import math
 import re
 from itertools import zip_longest
+from typing import Callable
 
 from d7print.utils import float_x1000
 
 MAX_LAYER = 99999  # just a protection from potential long loops
 # all known rule args
-_KNOWN_DATA = ('l', 'z', 'fd', 'adh', 'adn', 'fu', 'auh', 'aun', 'hl', 'hr', 'tb', 'te', 'ts', 'ta')
+_KNOWN_DATA = ('l', 'z', 'a', 'fd', 'adh', 'adn', 'fu', 'auh', 'aun', 'hl', 'hr', 'tb', 'te', 'ts', 'ta')
+_KNOWN_DATA_SET = frozenset(_KNOWN_DATA)  # fast membership checks of the attribute lookups
 # these arguments are given directly in internal units - no need to multiply by 1000
 _X1_DATA = ('l', 'fd', 'fu', 'adn', 'aun')
 # these arguments are matchers used to determine if the rule applies to the specific layer
 # they do not specify actual printing parameters
-_MATCHER_DATA = ('l', 'z')
+_MATCHER_DATA = ('l', 'z', 'a')
 
 
 class Ruleset:
@@ -20,7 +22,14 @@ class Ruleset:
 
     def __init__(self):
         self._directives: dict[int, RuleDirective] = {}
+        self._has_area = False  # some rule matches the lit area (checked only then)
         self._layer_positions: list[int] = [0]
+        self._area_source: Callable[[int], int | None] | None = None
+
+    def set_area_source(self, area_source: Callable[[int], int | None]):
+        """Set the function returning the lit area (1/1000 mm²) of the layer image at the given Z-position.
+        It should return 0 if there is no image and None if the area is unknown."""
+        self._area_source = area_source
 
     def get_rule_specs(self) -> list[str]:
         """Return a list of rules added to this ruleset in text form."""
@@ -29,6 +38,7 @@ class Ruleset:
     def clear(self):
         """Remove all rules."""
         self._directives.clear()
+        self._has_area = False
         self._layer_positions = [0]
 
     def add_rule(self, args: str):
@@ -36,6 +46,7 @@ class Ruleset:
         directive = RuleDirective(args)
         self._directives[directive.prio] = directive
         self._directives = dict(sorted(self._directives.items()))
+        self._has_area = any(d.has_area for d in self._directives.values())
         self._layer_positions = [0]
 
     def get_layer_rule(self, layer: int) -> 'CombinedRule':
@@ -44,13 +55,28 @@ class Ruleset:
         Some images might be skipped and others might be used by multiple layers."""
         z = self._get_position(layer)
         result = CombinedRule(layer, z)
+        has_area = self._has_area
+        area = None  # looked up only if there are area rules
         for d in self._directives.values():  # higher-numbered rules have priority
+            if has_area and d.has_area:  # Area rules additionally match the lit area of the layer image
+                area = self._get_area(layer, z) if area is None else area
+                if not d.a.matches(area):
+                    continue
+                if d.z.is_empty() and d.l.is_empty():  # pure area rules interpolate based on the area
+                    result.add_rule(d, d.a.fraction(area))
+                    continue
             if d.z.is_empty() and d.l.matches(layer):  # Layer-number rules interpolate based on layer number
                 result.add_rule(d, d.l.fraction(layer))
             elif d.l.is_empty() and d.z.matches(z):  # Height-range rules interpolate based on relative height
                 result.add_rule(d, d.z.fraction(z))
         return result
 
+    def _get_area(self, layer: int, z: int) -> int:
+        area = self._area_source(z) if self._area_source else None
+        if area is None:
+            raise ValueError(f'Lit area of layer #{layer} is unknown (the image pack is not scanned yet?)')
+        return area
+
     def _get_position(self, layer: int):
         """Compute layer Z-position based on @layer/@support directives."""
         if layer > MAX_LAYER:
@@ -193,16 +219,21 @@ class RuleDirective:
             # it's unclear how to compute layer height for rules like "every layer between 1 and 10mm should be 100um"
             raise ValueError('Positional rule can not reference layer number or layer height')
 
+        if self.a.is_present() and self.hl.is_present():
+            # layer image (and so its area) is determined by the layer position
+            raise ValueError('Area rule can not specify layer height')
+        self.has_area = self.a.is_present()
+
         val_range = any(v.is_range() for k, v in self._data.items() if k not in _MATCHER_DATA)
-        if not self.l.is_range() and not self.z.is_range() and val_range:
-            # speed or time ranges can only work when coupled with layer or height ranges
-            raise ValueError('Value range can not be used without layer or position range')
+        if not self.l.is_range() and not self.z.is_range() and not self.a.is_range() and val_range:
+            # speed or time ranges can only work when coupled with layer, height or area ranges
+            raise ValueError('Value range can not be used without layer, position or area range')
 
     def __getitem__(self, item):
         return self._data[item]
 
     def __getattribute__(self, name):
-        if name in _KNOWN_DATA:
+        if name in _KNOWN_DATA_SET:
             return self._data[name]
         return super().__getattribute__(name)
 
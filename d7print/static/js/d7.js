@@ -10,7 +10,7 @@ var cmd_queue = $('#cmd-queue')
 
 $('#btn-send').click(function() {
     var commands = cmd_to_send.val()
-    $.post('/api/exec', { cmd: commands }).done(function(data) {
+    $.post(printerPrefix + '/api/exec', { cmd: commands }).done(function(data) {
         if(data.status != 'ok') {
             alert(data.status)
         }
@@ -22,7 +22,7 @@ $('button[value]').click(function(obj) {
     var command = $(this).val()
     var text = $(this).text()
     if(command == 'hold' || command == 'resume' || confirm('Execute ' + text + ' action?')) {
-        $.post('/api/command', { cmd: command }).done(function(data) {
+        $.post(printerPrefix + '/api/command', { cmd: command }).done(function(data) {
             if(data.status != 'ok') {
                 alert(data.status)
             }
@@ -33,7 +33,7 @@ $('button[value]').click(function(obj) {
 
 btn_load.click(function() {
     var file = file_select.val()
-    $.post('/api/load', { file: file }).done(function(data) {
+    $.post(printerPrefix + '/api/load', { file: file }).done(function(data) {
         if(data.status != 'ok') {
             alert(data.status)
         } else {
@@ -45,10 +45,22 @@ btn_load.click(function() {
     return false
 })
 
+$('#btn-print').click(function() {
+    var file = file_select.val()
+    if(file && confirm('Print ' + file + '?')) {
+        $.post(printerPrefix + '/api/print', { file: file }).done(function(data) {
+            if(data.status != 'ok') {
+                alert(data.status)
+            }
+        })
+    }
+    return false
+})
+
 btn_delete.click(function() {
     var file = file_select.val()
     if(confirm('Delete ' + file + '?')) {
-        $.post('/api/delete', { file: file }).done(function(data) {
+        $.post(printerPrefix + '/api/delete', { file: file }).done(function(data) {
             if(data.status != 'ok') {
                 alert(data.status)
             } else {
@@ -59,11 +71,197 @@ btn_delete.click(function() {
     return false
 })
 
+var upload_chunk_size = 1024 * 1024
+var upload_hash_size = 4 * 1024 * 1024
+var upload_retries = 10
+
+// Incremental SHA-256 of the uploaded file - WebCrypto needs a secure context (not available over plain http)
+// and can not hash a large file in parts.
+var SHA256_K = [
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2]
+
+function Sha256() {
+    this.h = [0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19]
+    this.w = new Int32Array(64)
+    this.buf = new Uint8Array(64)
+    this.buf_len = 0
+    this.length = 0
+}
+
+Sha256.prototype.update = function(data) {
+    var pos = 0
+    this.length += data.length
+    if(this.buf_len) {
+        pos = Math.min(64 - this.buf_len, data.length)
+        this.buf.set(data.subarray(0, pos), this.buf_len)
+        this.buf_len += pos
+        if(this.buf_len < 64) {
+            return
+        }
+        this.block(this.buf, 0)
+        this.buf_len = 0
+    }
+    for(; pos + 64 <= data.length; pos += 64) {
+        this.block(data, pos)
+    }
+    this.buf.set(data.subarray(pos), 0)
+    this.buf_len = data.length - pos
+}
+
+Sha256.prototype.block = function(d, p) {
+    var w = this.w, h = this.h, i
+    for(i = 0; i < 16; i++, p += 4) {
+        w[i] = d[p] << 24 | d[p + 1] << 16 | d[p + 2] << 8 | d[p + 3]
+    }
+    for(i = 16; i < 64; i++) {
+        var x = w[i - 15], y = w[i - 2]
+        var s0 = (x >>> 7 | x << 25) ^ (x >>> 18 | x << 14) ^ x >>> 3
+        var s1 = (y >>> 17 | y << 15) ^ (y >>> 19 | y << 13) ^ y >>> 10
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1 | 0
+    }
+    var a = h[0], b = h[1], c = h[2], e = h[4], f = h[5], g = h[6], k = h[7], dd = h[3]
+    for(i = 0; i < 64; i++) {
+        var t1 = k + ((e >>> 6 | e << 26) ^ (e >>> 11 | e << 21) ^ (e >>> 25 | e << 7)) +
+            (e & f ^ ~e & g) + SHA256_K[i] + w[i] | 0
+        var t2 = ((a >>> 2 | a << 30) ^ (a >>> 13 | a << 19) ^ (a >>> 22 | a << 10)) + (a & b ^ a & c ^ b & c) | 0
+        k = g; g = f; f = e; e = dd + t1 | 0; dd = c; c = b; b = a; a = t1 + t2 | 0
+    }
+    h[0] = h[0] + a | 0; h[1] = h[1] + b | 0; h[2] = h[2] + c | 0; h[3] = h[3] + dd | 0
+    h[4] = h[4] + e | 0; h[5] = h[5] + f | 0; h[6] = h[6] + g | 0; h[7] = h[7] + k | 0
+}
+
+Sha256.prototype.hex = function() {
+    var bits = this.length * 8
+    var pad = new Uint8Array((this.buf_len < 56 ? 64 : 128) - this.buf_len)
+    pad[0] = 0x80
+    for(var i = 1; i <= 8; i++, bits = Math.floor(bits / 256)) {
+        pad[pad.length - i] = bits % 256
+    }
+    this.update(pad)
+    return this.h.map(function(v) { return ('0000000' + (v >>> 0).toString(16)).slice(-8) }).join('')
+}
+
+// Hash the file in parts, calls progress(offset) after each part and done(hex digest) at the end.
+function hash_file(file, progress, done) {
+    var sha = new Sha256()
+    var reader = new FileReader()
+    var offset = 0
+    reader.onload = function() {
+        sha.update(new Uint8Array(reader.result))
+        offset += reader.result.byteLength
+        progress(offset)
+        if(offset < file.size) {
+            reader.readAsArrayBuffer(file.slice(offset, offset + upload_hash_size))
+        } else {
+            done(sha.hex())
+        }
+    }
+    reader.onerror = function() { alert('Failed to read the file: ' + reader.error) }
+    reader.readAsArrayBuffer(file.slice(0, upload_hash_size))
+}
+
+// Chunked resumable upload: asks the server for the already received size and continues from there.
+// The partial data is identified by the name, size and modification time of the file,
+// the server checks the SHA-256 computed here when the last chunk is received.
+// Falls back to the plain form upload if the browser does not support File.slice.
+$('#form-upload').submit(function() {
+    var file = $('#customFile').get(0).files[0]
+    if(!file || !file.slice || !window.FileReader) {
+        return true
+    }
+    var label = $('label[for="customFile"]')
+    var retries = upload_retries
+    var sha256 = ''
+    var url = function(params) {
+        return '/api/upload?' + $.param($.extend({ name: file.name, total: file.size, id: file.lastModified || 0 }, params))
+    }
+    var percent = function(offset) { return Math.floor(offset * 100 / Math.max(file.size, 1)) + '%' }
+
+    var send_from = function(offset) {
+        label.text(file.name + ': ' + percent(offset))
+        $.ajax(url({ offset: offset, sha256: sha256 }), {
+            method: 'POST',
+            data: file.slice(offset, offset + upload_chunk_size),
+            processData: false,
+            contentType: 'application/octet-stream',
+            timeout: 60000
+        }).done(function(data) {
+            if(data.done) {
+                window.location = printerPrefix + '/?select=' + encodeURIComponent(data.name)
+            } else if(data.status == 'ok' || data.status == 'Offset mismatch') {
+                retries = upload_retries
+                send_from(data.offset)
+            } else {
+                alert(data.status)
+            }
+        }).fail(retry)
+    }
+
+    var retry = function() {
+        if(retries-- <= 0) {
+            alert('Upload failed')
+            return
+        }
+        setTimeout(function() {
+            $.ajax(url({}), { timeout: 5000 }).done(function(data) {
+                if(data.status == 'ok') {
+                    send_from(data.offset)
+                } else {
+                    alert(data.status)
+                }
+            }).fail(retry)
+        }, 2000)
+    }
+
+    hash_file(file, function(offset) {
+        label.text(file.name + ': checksum ' + percent(offset))
+    }, function(digest) {
+        sha256 = digest
+        $.ajax(url({}), { timeout: 5000 }).done(function(data) {
+            if(data.status == 'ok') {
+                send_from(data.offset)
+            } else {
+                alert(data.status)
+            }
+        }).fail(retry)
+    })
+    return false
+})
+
 form_cmd.submit(function() {
     command = text_cmd.val().trim()
     text_cmd.val('')
     if(command) {
-        $.post('/api/exec', { cmd: command }).done(function(data) {
+        $.post(printerPrefix + '/api/exec', { cmd: command }).done(function(data) {
+            if(data.status != 'ok') {
+                alert(data.status)
+            }
+        })
+    }
+    return false
+})
+
+var preview_slice = $('#preview-slice')
+var preview_timer = null
+preview_slice.on('input', function() {
+    var slice = preview_slice.val()
+    $('#preview-slice-number').text(slice)
+    clearTimeout(preview_timer)
+    preview_timer = setTimeout(function() {  // do not request every slice while scrubbing
+        $('#preview-img').attr('src', printerPrefix + '/api/preview?mask=1&slice=' + slice)
+    }, 150)
+})
+
+$('#btn-resume-print').click(function() {
+    if(confirm('Re-home the printer and resume the interrupted print?')) {
+        $.post(printerPrefix + '/api/resume_print').done(function(data) {
             if(data.status != 'ok') {
                 alert(data.status)
             }
@@ -76,7 +274,7 @@ var last_log_id = -1
 var last_log_time = 0
 var last_cfg_version = 0
 setInterval(function() {
-    $.ajax('/api/info', {
+    $.ajax(printerPrefix + '/api/info', {
         data: {time: Math.floor(last_log_time), cfg_version: last_cfg_version},
         timeout: 2000
     }).done(function(data) {
@@ -105,6 +303,17 @@ setInterval(function() {
 
             $('#text-grbl-state').val(data.state)
             $('#title-file-name').text(data.file ? data.file : '<Root dir>')
+            if(data.resume) {
+                $('#resume-pack').text(data.resume.pack)
+                $('#resume-layer').text(data.resume.layer)
+                $('#resume-alert').show()
+            } else {
+                $('#resume-alert').hide()
+            }
+            if(preview_slice.attr('max') != data.slices) {
+                preview_slice.attr('max', Math.max(data.slices, 1))
+                preview_slice.trigger('input')
+            }
         } else {
             $('#text-grbl-state').val(data.status)
         }
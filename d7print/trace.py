@@ -0,0 +1,118 @@
+import struct
+import threading
+import time
+from collections import deque
+from typing import Iterator
+
+from d7print.utils import lower_thread_priority
+
+# Event kinds
+SEND = 1  # bytes written to GRBL
+RECV = 2  # bytes read from GRBL
+EXEC = 3  # a queued command executed by HwManager
+IMMEDIATE = 4  # an immediate command executed by HwManager (not from the queue)
+DISPLAY = 5  # an image written to the frame buffer (payload is its name, "blank" for black)
+DELAY = 6  # a delay deadline (payload is a monotonic time packed as a double)
+META = 7  # JSON trace metadata (printer, image pack, cached GRBL settings)
+REALTIME = 8  # a real-time command sent by an API thread (hold, resume, stop)
+
+_MAGIC = b'D7TRACE1'
+_RECORD = struct.Struct('<dBH')  # monotonic time, kind, payload length
+_DOUBLE = struct.Struct('<d')
+_MAX_PAYLOAD = 0xFFFF
+
+
+class TraceRecorder:
+    """Compact binary trace of the hardware I/O: a file header followed by (time, kind, length, payload) records.
+    Recording only appends the record to an in-memory batch. Full batches are put into a ring of pending batches
+    written to the file by a background thread, so the recording threads never wait for the SD card.
+    If the writer falls behind the whole ring, the oldest batches are dropped (and counted)."""
+
+    def __init__(self, path: str, batch_size: int = 64 << 10, max_pending: int = 64, flush_period: float = 1.0):
+        self.path = path
+        self._batch_size = batch_size
+        self._flush_period = flush_period
+        self._file = open(path, 'wb')
+        self._file.write(_MAGIC)
+        self._batch = bytearray()
+        self._pending: deque[bytes] = deque(maxlen=max_pending)
+        self._dropped = 0
+        self._records = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_thread, name='trace_writer', daemon=True)
+        self._writer.start()
+
+    def record(self, kind: int, payload: bytes | str):
+        """Append an event with the current monotonic time."""
+        now = time.monotonic()
+        if isinstance(payload, str):
+            payload = payload.encode('utf8', 'replace')
+        payload = payload[:_MAX_PAYLOAD]
+        with self._lock:
+            self._batch += _RECORD.pack(now, kind, len(payload))
+            self._batch += payload
+            self._records += 1
+            if len(self._batch) >= self._batch_size:
+                self._swap()
+
+    def record_time(self, kind: int, value: float):
+        """Append an event carrying a time value (e.g. a delay deadline)."""
+        self.record(kind, _DOUBLE.pack(value))
+
+    def get_info(self) -> dict:
+        """{path: string, records: int, dropped: int (batches lost because the writer was too slow)}"""
+        return {'path': self.path, 'records': self._records, 'dropped': self._dropped}
+
+    def close(self):
+        """Write everything recorded so far and close the file."""
+        with self._lock:
+            self._swap()
+            self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self._file.close()
+
+    def _swap(self):
+        if self._batch:
+            if len(self._pending) == self._pending.maxlen:
+                self._dropped += 1
+            self._pending.append(bytes(self._batch))
+            self._batch.clear()
+            self._wakeup.set()
+
+    def _write_thread(self):
+        try:
+            lower_thread_priority()
+        except OSError:
+            pass
+        while True:
+            self._wakeup.wait(self._flush_period)
+            self._wakeup.clear()
+            with self._lock:
+                if not self._pending:  # nothing full yet - flush the partial batch now and then
+                    self._swap()
+                batches = list(self._pending)
+                self._pending.clear()
+                closed = self._closed
+            for batch in batches:
+                self._file.write(batch)
+            self._file.flush()
+            if closed:
+                return
+
+
+def read_trace(path: str) -> Iterator[tuple[float, int, bytes]]:
+    """Read the trace records: (monotonic time, kind, payload)."""
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f'Not a d7print trace: {path}')
+        while header := f.read(_RECORD.size):
+            if len(header) < _RECORD.size:  # torn last record
+                return
+            t, kind, length = _RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield t, kind, payload
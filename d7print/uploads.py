@@ -0,0 +1,148 @@
+import hashlib
+import os
+import re
+from threading import Lock
+from typing import BinaryIO
+from zipfile import ZipFile, BadZipFile
+
+CHUNK_READ_SIZE = 65536
+
+
+class UploadManager:
+    """Receives large files in resumable chunks.
+    Partial files are kept in a separate directory next to the uploads dir (so they never show up in the file list)
+    and hashed as they are written. A partial file is keyed by the name, the total size and a client file id
+    (e.g. its modification time), so a different file uploaded under the same name never resumes someone else's data.
+    A complete file is validated (ZIP central directory, optional SHA-256),
+    synced and atomically moved to the uploads dir."""
+
+    def __init__(self, uploads_dir: str, max_size: int):
+        self._uploads_dir = uploads_dir
+        self._partial_dir = uploads_dir.rstrip('/') + '.partial/'  # same file system - allows atomic rename
+        self._max_size = max_size
+        os.makedirs(self._partial_dir, 0o755, exist_ok=True)
+        self._hashes: dict[str, tuple[int, 'hashlib._Hash']] = {}  # partial name -> (hashed size, running hash)
+        self._lock = Lock()
+
+    def get_offset(self, name: str, total: int, file_id: str) -> int:
+        """Get the number of bytes already received for the given file (0 if unknown)."""
+        return self._get_size(self._partial_name(name, total, file_id))
+
+    def write_chunk(self, name: str, offset: int, total: int, file_id: str, stream: BinaryIO,
+                    sha256: str = '') -> dict:
+        """Append the data from the stream to the partial file.
+        The offset must be equal to the size of the already received data. Publishes the file when total is reached.
+        Returns {offset: int, done: bool, sha256: string (when done)}."""
+        if total > self._max_size:
+            raise ValueError(f'File is too large: {total} > {self._max_size}')
+
+        with self._lock:
+            partial = self._partial_name(name, total, file_id)
+            path = self._partial_dir + partial
+            size = self._get_size(partial)
+            if offset != size:
+                return {'offset': size, 'done': False, 'error': 'Offset mismatch'}
+            if not size:
+                self._drop_stale(name, partial)
+
+            _, digest = self._get_hash(partial, size)
+            with open(path, 'ab') as f:
+                try:
+                    while block := stream.read(CHUNK_READ_SIZE):
+                        if size + len(block) > total:
+                            raise ValueError('Received more data than expected')
+                        f.write(block)
+                        digest.update(block)
+                        size += len(block)
+                finally:  # keep whatever was received so far (it is hashed) to allow resuming
+                    f.truncate(size)
+                    self._hashes[partial] = (size, digest)
+
+                if size < total:
+                    return {'offset': size, 'done': False}
+
+                f.flush()
+                os.fsync(f.fileno())
+
+            del self._hashes[partial]
+            hex_digest = digest.hexdigest()
+            if sha256 and sha256.lower() != hex_digest:
+                os.unlink(path)  # corrupted - start from scratch
+                raise ValueError(f'SHA-256 mismatch: got {hex_digest}')
+            self._publish(path, name)
+            return {'offset': size, 'done': True, 'sha256': hex_digest}
+
+    def save(self, name: str, stream: BinaryIO) -> str:
+        """Receive a whole file in one go (plain form upload) and publish it. Returns its SHA-256."""
+        with self._lock:
+            path = self._partial_dir + name
+            self._hashes.pop(name, None)
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with open(path, 'wb') as f:
+                    while block := stream.read(CHUNK_READ_SIZE):
+                        size += len(block)
+                        if size > self._max_size:
+                            raise ValueError(f'File is too large: more than {self._max_size}')
+                        f.write(block)
+                        digest.update(block)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except Exception:
+                os.unlink(path)
+                raise
+            self._publish(path, name)
+            return digest.hexdigest()
+
+    @staticmethod
+    def _partial_name(name: str, total: int, file_id: str) -> str:
+        if not re.fullmatch(r'[\w-]+', file_id):
+            raise ValueError('Bad file id')
+        return f'{name}.{total}.{file_id}'
+
+    def _get_size(self, partial: str) -> int:
+        try:
+            return os.path.getsize(self._partial_dir + partial)
+        except FileNotFoundError:
+            return 0
+
+    def _drop_stale(self, name: str, partial: str):
+        """Delete the partial data of other files uploaded under the same name - they can not be resumed anymore."""
+        pattern = re.compile(re.escape(name) + r'\.\d+\.[\w-]+')
+        for entry in os.scandir(self._partial_dir):
+            if entry.name != partial and pattern.fullmatch(entry.name):
+                os.unlink(entry.path)
+                self._hashes.pop(entry.name, None)
+
+    def _get_hash(self, partial: str, size: int):
+        """Get the running hash of the partial file. Rehash it from disk if the state is lost (e.g. after restart)."""
+        hashed, digest = self._hashes.get(partial, (-1, None))
+        if hashed != size:
+            digest = hashlib.sha256()
+            if size:
+                with open(self._partial_dir + partial, 'rb') as f:
+                    while block := f.read(CHUNK_READ_SIZE):
+                        digest.update(block)
+            self._hashes[partial] = (size, digest)
+        return size, digest
+
+    def _publish(self, path: str, name: str):
+        """Validate the complete partial file and atomically move it to the uploads dir. Delete it if invalid."""
+        try:
+            self._validate(path, name)
+        except Exception:
+            os.unlink(path)
+            raise
+        os.replace(path, self._uploads_dir + name)
+
+    @staticmethod
+    def _validate(path: str, name: str):
+        if name.lower().endswith(('.gcode', '.png')):
+            return
+        try:
+            with ZipFile(path) as zf:  # parses the central directory
+                if not zf.namelist():
+                    raise ValueError('Archive is empty')
+        except BadZipFile as e:
+            raise ValueError(f'Invalid archive: {e}')
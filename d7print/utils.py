@@ -1,4 +1,8 @@
+import os
 import re
+import threading
+from typing import Iterator
+from zipfile import ZipFile
 
 
 def float_x1000(spec: str|int):
@@ -12,4 +16,20 @@ def sorted_alphanum(lst):
     def make_key(text):
         return [convert(c) for c in re.split('([0-9]+)', text)]
 
-    return sorted(lst, key = make_key)
\ No newline at end of file
+    return sorted(lst, key = make_key)
+
+def read_lines(path: str, member: str = '') -> Iterator[str]:
+    """Lazily read text lines (without line endings) from a file or from a zip archive member."""
+    if member:
+        with ZipFile(path) as zf, zf.open(member) as f:
+            for line in f:
+                yield str(line, 'utf8').rstrip()
+    else:
+        with open(path) as f:
+            for line in f:
+                yield line.rstrip()
+
+
+def lower_thread_priority():
+    """Give the calling thread the lowest CPU priority (Linux: the nice value is per thread). Raises OSError."""
+    os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)